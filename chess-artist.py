@@ -34,8 +34,20 @@ import subprocess
 import os
 import sys
 import math
-import chess
-from chess import pgn
+import time
+import socket
+import threading
+import multiprocessing
+import json
+import struct
+import mmap
+import re
+import importlib
+import hashlib
+import collections
+import array
+import Queue
+from cStringIO import StringIO
 
 # Constants
 APP_NAME = 'Chess Artist'
@@ -52,8 +64,121 @@ SLIGHT_SCORE = +0.75
 MODERATE_SCORE = +1.50
 DECISIVE_SCORE = +3.0
 COMPLEXITY_MINIMUM_TIME = 2000
+COMPLEXITY_MULTIPV = 3
+COMPLEXITY_MULTIPV_DEPTH = 8
+COMPLEXITY_MULTIPV_LIMIT = 300
 DEFAULT_HASH = 32
 DEFAULT_THREADS = 1
+SAN_CACHE_SIZE = 100000
+OPENING_TREE_PLIES = 2 * BOOK_MOVE_LIMIT
+TRIAGE_DECISIVE_PLIES = 4
+TRIAGE_MATE_SCORE = (MAX_SCORE - 1000) / 100.0
+TRIAGE_TIME_DIVISOR = 4
+SCAN_SCORE_MARGIN = 0.10
+PIPELINE_QUEUE_SIZE = 8
+
+# The jobs that search the moves of the games, and the nags of the moves
+# whose positions -job extract writes.
+ANALYZE_JOBS = ['analyze', 'extract']
+EXTRACT_NAGS = [4, 2]
+DEFAULT_STABLE_DEPTH = 3
+SOLVE_CURVE_POINTS = 8
+COMPARE_SCORE_LIMIT = 1000
+CALIBRATE_DEPTH = 12
+CALIBRATE_POSITIONS = 16
+CALIBRATE_MIN_HASH = 16
+CALIBRATE_MAX_HASH = 16384
+
+# Options that don't change the annotation of a game, an -incremental
+# output made with other values of them can still be used.
+INCREMENTAL_IGNORED_OPTIONS = ['-incremental', '-records', '-dedup',
+                               '-openingtree', '-session', '-direction',
+                               '-stabledepth', '-watch', '-poll',
+                               '-sharedcache', '-sharedcachesize',
+                               '-pipeline']
+
+# Time in millisec between checks of the pgn file in -watch on.
+DEFAULT_POLL_TIME = 500
+
+# A new ply of a live game has a search before and after its move, the
+# -latency budget of an update is shared by these searches.
+LATENCY_SEARCHES_PER_PLY = 2
+
+# A ply in a -records .bin file: zobrist, game, ply, side, move, best
+# move, score, engine score, complexity number, move changes, nag,
+# depth, nodes and search time. Scores are in centipawns.
+RECORD_FORMAT = '<QIHB5s5siiHHBHQI'
+RECORD_NO_SCORE = -2**31
+
+# A slot of the -sharedcache table is the key xor the checksum of the
+# data, then score, depth, complexity number, move changes, nodes, time
+# and pv. The checksum is the xor of the 7 words of the data.
+SHARED_CACHE_DATA = '<iHHHQI30s4x'
+SHARED_CACHE_SLOT_SIZE = 64
+SHARED_CACHE_HEADER_SIZE = 64
+SHARED_CACHE_PROBES = 4
+SHARED_CACHE_KINDS = ['before', 'after', 'static', 'scanbefore', 'scanafter']
+DEFAULT_SHARED_CACHE_SIZE = 64
+
+ENGINE_PROBE_FILE = os.path.join(os.path.expanduser('~'),
+                                 '.chess-artist-engines.json')
+
+# A tag line and a movetext line in a pgn file.
+TAG_LINE = re.compile(r'^\[', re.M)
+MOVETEXT_LINE = re.compile(r'^(?![\[%])[ \t]*\S', re.M)
+NON_SPACE = re.compile(r'\S')
+
+# A token of pgn movetext: comment, escape line, variation start or end,
+# nag, move number or a word like a san move or a result.
+PGN_TOKEN = re.compile(r'\{[^}]*\}?|;[^\n]*|^%[^\n]*|[()]|\$\d+|\d+\.+|'
+                       r'[^\s{};()$]+', re.M)
+PGN_TAG = re.compile(r'\s*^\[([A-Za-z0-9_]+)\s+"(.*)"\][ \t\r]*$', re.M)
+PGN_RESULTS = ['1-0', '0-1', '1/2-1/2', '*']
+
+# Games that -job readbench also compares, with castling written 0-0.
+READBENCH_CHECK_GAMES = ['[Result "*"]\n\n1. e4 e5 2. Nf3 Nc6 3. Bc4 Bc5 '
+                         '4. 0-0 Nf6 5. d3 d6 6. Bg5 Bg4 7. Nc3 Qd7 '
+                         '8. Qd2 0-0-0 9. a3 h6 *\n']
+
+# A condition of -filter, the tag, the operator and the values.
+FILTER_CONDITION = re.compile(r'^\s*([A-Za-z0-9_]+)\s*(>=|<=|!=|=|>|<|~)\s*(.*?)\s*$')
+DEFAULT_LEASE_TIME = 600
+QUEUE_POLL_TIME = 1.0
+DEFAULT_SERVER_PORT = 8700
+
+# The options of class Analyze and their defaults. The command line, the
+# workers and the chessartist package take the options from here.
+ANALYZE_OPTIONS = {'-book': 'none', # ['none', 'cerebellum', 'polyglot']
+                   '-eval': 'static', # ['none', 'static', 'search']
+                   '-movetime': 0,
+                   '-movestart': 8,
+                   '-job': 'analyze', # ['none' 'analyze', 'test', 'solve',
+                                      #  'compare', 'calibrate',
+                                      #  'readbench', 'extract']
+                   '-engoptions': 'none',
+                   '-timealloc': 'none', # ['none', 'complexity']
+                   '-dedup': 'off', # ['off', 'on']
+                   '-openingtree': 'off', # ['off', 'on']
+                   '-theory': 0,
+                   '-triage': 'off', # ['off', 'on']
+                   '-stabledepth': DEFAULT_STABLE_DEPTH,
+                   '-session': 'none', # ['none', 'game']
+                   '-direction': 'forward', # ['forward', 'backward']
+                   '-records': 'none',
+                   '-incremental': 'off', # ['off', 'on']
+                   '-watch': 'off', # ['off', 'on']
+                   '-poll': DEFAULT_POLL_TIME,
+                   '-latency': 0,
+                   '-sharedcache': 'none',
+                   '-sharedcachesize': DEFAULT_SHARED_CACHE_SIZE,
+                   '-complexity': 'movechanges', # ['movechanges', 'multipv']
+                   '-scantime': 0,
+                   '-filter': 'none',
+                   '-pipeline': 'off' # ['off', 'on']
+                   }
+
+# Returned by Analyze.GetAnalysis for a result that is not analyzed yet.
+ANALYSIS_PENDING = object()
 
 def PrintProgram():
     """ Prints program name and version """
@@ -67,7 +192,7 @@ def DeleteFile(fn):
 def CheckFiles(infn, outfn, engfn):
     """ Quit program if infn is missing.
         Quit program if infn and outfn is the same.
-        Quit program if engfn is missing.
+        Quit program if engfn is missing, engfn is not checked if None.
         Quit program if input file type is not epd or pgn
     """
     # input file is missing
@@ -81,7 +206,7 @@ def CheckFiles(infn, outfn, engfn):
         sys.exit(1)
 
     # engine file is missing.
-    if not os.path.isfile(engfn):
+    if engfn is not None and not os.path.isfile(engfn):
         print('Error! %s is missing' %(engfn))
         sys.exit(1)
 
@@ -106,8 +231,255 @@ def GetOptionValue(opt, optName, var):
             var = int(var)
         elif optName == '-movestart':
             var = int(var)
+        elif optName == '-lease':
+            var = int(var)
+        elif optName == '-workers':
+            var = int(var)
+        elif optName == '-jobsize':
+            var = int(var)
+        elif optName == '-theory':
+            var = int(var)
+        elif optName == '-stabledepth':
+            var = int(var)
+        elif optName == '-benchdepth':
+            var = int(var)
+        elif optName == '-ram':
+            var = int(var)
+        elif optName == '-poll':
+            var = int(var)
+        elif optName == '-latency':
+            var = int(var)
+        elif optName == '-port':
+            var = int(var)
+        elif optName == '-sharedcachesize':
+            var = int(var)
+        elif optName == '-scantime':
+            var = int(var)
     return var
 
+class LazyModule(object):
+    """ A module that is imported when it is used for the first time,
+        the submodules are imported with it.
+    """
+    def __init__(self, name, submodules=[]):
+        self.__dict__['name'] = name
+        self.__dict__['submodules'] = submodules
+        self.__dict__['module'] = None
+
+    def __getattr__(self, attr):
+        if self.module is None:
+            module = importlib.import_module(self.name)
+            for sub in self.submodules:
+                importlib.import_module(sub)
+            self.__dict__['module'] = module
+        return getattr(self.module, attr)
+
+# python-chess is only imported when a board or a game is needed.
+chess = LazyModule('chess', ['chess.pgn', 'chess.polyglot'])
+
+def MapFile(fn):
+    """ Returns a read only memory map of file fn, or an empty string
+        when the file is empty as it can not be mapped.
+    """
+    with open(fn, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return ''
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+def GetPgnGameOffsets(data):
+    """ Yields the start and end offsets of each game in the pgn data. A
+        game ends when a tag line that is not in a comment is found after
+        its movetext. Only the boundaries are searched, the data between
+        them is not copied.
+    """
+    start, moveStart = 0, 0
+    for m in TAG_LINE.finditer(data):
+        t = m.start()
+        if t < moveStart:
+            continue
+        if MOVETEXT_LINE.search(data, moveStart, t):
+            # Don't take a tag like line inside a comment as new game.
+            if data.rfind('{', moveStart, t) > data.rfind('}', moveStart, t):
+                continue
+            yield start, t
+            start = t
+
+        # The movetext starts after the last tag line.
+        moveStart = data.find('\n', t)
+        if moveStart < 0:
+            moveStart = len(data)
+    if NON_SPACE.search(data, start):
+        yield start, len(data)
+
+class MainLineGame():
+    """ A game of ReadMainLineGame, the headers and the main line moves
+        packed in an array as from + to*64 + promotion*4096. It has the
+        headers, board() and main_line() of a chess.pgn.Game.
+    """
+    def __init__(self, root, moves):
+        self.root = root
+        self.headers = root.headers
+        self.moves = moves
+
+    def board(self):
+        """ Returns the starting position of the game """
+        return self.root.board()
+
+    def main_line(self):
+        """ Yields the moves of the main line """
+        for m in self.moves:
+            yield chess.Move(m & 63, (m >> 6) & 63, (m >> 12) or None)
+
+def ReadPgnTags(text, start=0, end=None):
+    """ Returns the tag pairs at the start of the game in pgn text from
+        offset start, and the offset of its movetext. The movetext is not
+        read.
+    """
+    if end is None:
+        end = len(text)
+    tags, pos = [], start
+    m = PGN_TAG.match(text, pos, end)
+    while m:
+        tags.append((m.group(1), m.group(2)))
+        pos = m.end()
+        m = PGN_TAG.match(text, pos, end)
+    return tags, pos
+
+def GetGameFilter(filterOpt):
+    """ Returns the conditions of -filter as a list of tag, operator and
+        values, the conditions are separated by ';' and the values of a
+        condition by '|'. Raises ValueError for a condition that is not
+        valid.
+    """
+    conditions = []
+    if filterOpt == 'none':
+        return conditions
+    for c in filterOpt.split(';'):
+        m = FILTER_CONDITION.match(c)
+        if m is None or not m.group(3):
+            raise ValueError('Invalid -filter condition %s' %(c))
+        conditions.append((m.group(1), m.group(2), m.group(3).split('|')))
+    return conditions
+
+def CompareTagValue(field, op, value):
+    """ Returns the result of the comparison of tag value field and the
+        value of a -filter condition. Numbers are compared as numbers,
+        an unknown tag value or a tag without a number is not selected
+        by a comparison.
+    """
+    if op == '~':
+        return value.lower() in field.lower()
+    if op == '=':
+        return field.lower() == value.lower()
+    if field in ['', '?']:
+        return False
+    try:
+        a = float(value)
+    except ValueError:
+        a, b = value, field
+    else:
+        try:
+            b = float(field)
+        except ValueError:
+            return False
+    if op == '>=':
+        return b >= a
+    if op == '<=':
+        return b <= a
+    if op == '>':
+        return b > a
+    return b < a
+
+def IsGameSelected(conditions, tags):
+    """ Returns True when the tags of a game meet all the conditions of
+        -filter. A condition is met when one of its values matches, the
+        tag Player matches White or Black and != is met when no value
+        is equal.
+    """
+    headers = dict(tags)
+    for tag, op, values in conditions:
+        if tag == 'Player':
+            fields = [headers.get('White', '?'), headers.get('Black', '?')]
+        else:
+            fields = [headers.get(tag, '?')]
+        if op == '!=':
+            isMet = not any([CompareTagValue(f, '=', v)
+                             for f in fields for v in values])
+        else:
+            isMet = any([CompareTagValue(f, op, v)
+                         for f in fields for v in values])
+        if not isMet:
+            return False
+    return True
+
+def ReadMainLineGame(text):
+    """ Returns a MainLineGame of the first game in pgn text, or None
+        if there is no game. Comments, nags and variations are skipped
+        by the tokenizer, only the san moves of the main line are parsed.
+    """
+    # The tag lines are at the start of the game.
+    root = chess.pgn.Game()
+    tags, pos = ReadPgnTags(text)
+    for k, v in tags:
+        root.headers[k] = v
+    isFound = len(tags) > 0
+
+    try:
+        board = root.board()
+    except ValueError:
+        board = chess.Board()
+    moves = array.array('H')
+    depth = 0
+    # The movetext ends at the tags of a next game.
+    end = next(GetPgnGameOffsets(text), (0, len(text)))[1]
+    for m in PGN_TOKEN.finditer(text, pos, end):
+        token = m.group(0)
+        c = token[0]
+        if c == '(':
+            depth += 1
+            continue
+        if c == ')':
+            depth = max(0, depth - 1)
+            continue
+        if depth or c in '{;%$' or c.isdigit() and token.endswith('.'):
+            continue
+        if token in PGN_RESULTS:
+            if root.headers.get('Result', '*') == '*':
+                root.headers['Result'] = token
+            isFound = True
+            continue
+        san = token.rstrip('!?')
+        if not san:
+            continue
+
+        # Castling may be written with zeros.
+        if san.startswith('0-0'):
+            san = san.replace('0', 'O')
+
+        # An illegal move is skipped like chess.pgn.read_game does.
+        try:
+            move = board.parse_san(san)
+        except ValueError:
+            continue
+        board.push(move)
+        moves.append(move.from_square | move.to_square << 6 |
+                     (move.promotion or 0) << 12)
+        isFound = True
+    if not isFound:
+        return None
+    return MainLineGame(root, moves)
+
+def ReadFileLines(fn):
+    """ Yields the lines of file fn from a memory map of the file """
+    data = MapFile(fn)
+    if not data:
+        return
+    try:
+        for line in iter(data.readline, ''):
+            yield line
+    finally:
+        data.close()
+
 class Analyze():
     """ An object that will read and annotate games in a pgn file """
     def __init__(self, infn, outfn, eng, **opt):
@@ -121,16 +493,104 @@ class Analyze():
         self.moveStartOpt = opt['-movestart']
         self.jobOpt = opt['-job']
         self.engOpt = opt['-engoptions']
+        self.timeAllocOpt = opt['-timealloc']
+        self.dedupOpt = opt['-dedup']
+        self.openingTreeOpt = opt['-openingtree']
+        self.theoryOpt = opt['-theory']
+        self.triageOpt = opt['-triage']
+        self.stableDepthOpt = opt['-stabledepth']
+        self.sessionOpt = opt['-session']
+        self.directionOpt = opt['-direction']
+        self.recordsOpt = opt['-records']
+        self.complexityOpt = opt['-complexity']
+        self.scanTimeOpt = opt['-scantime']
+        self.filterOpt = opt['-filter']
+        self.pipelineOpt = opt['-pipeline']
+        self.gameFilter = GetGameFilter(self.filterOpt)
+        self.gameCnt = 0
+
+        # The chessartist package does not print the progress.
+        self.isQuiet = False
+
+        self.watchOpt = opt['-watch']
+        self.pollOpt = opt['-poll']
+        self.latencyOpt = opt['-latency']
+
+        # Backward analysis and live games are done on a warm engine.
+        if self.directionOpt == 'backward' or self.watchOpt == 'on':
+            self.sessionOpt = 'game'
+        self.sessionEngine = None
+        self.ponderPos = None
+        self.ponderStart = 0
+        self.ponderLines = []
+        self.ponderThread = None
+        self.sessionRoot = None
+        self.sessionMoves = []
+        self.sessionPositions = {}
+        self.incrementalOpt = opt['-incremental']
+        self.unchangedGames = {}
+        self.openingTree = None
+        self.treeHits = 0
         self.writeCnt = 0
-        self.engIdName = self.GetEngineIdName()
+        self.sanCache = {}
+        self.analysisCache = None
+        self.analysisQueries = {}
+        self.pendingAnalysis = {}
+        self.isPlanning = False
+        self.engineProbe = self.GetEngineProbe()
+        self.engIdName = self.engineProbe['idName']
+
+        # Output made with the same engine and options can be reused.
+        self.optionsKey = hashlib.sha1(repr([self.engIdName] + sorted(
+            [(k, v) for k, v in opt.items()
+             if k not in INCREMENTAL_IGNORED_OPTIONS]))).hexdigest()
+
+        # Engine results shared with the other processes of the computer.
+        self.sharedCacheOpt = opt['-sharedcache']
+        self.sharedCache = None
+        if self.sharedCacheOpt != 'none':
+            try:
+                self.sharedCache = SharedCache(self.sharedCacheOpt,
+                                               opt['-sharedcachesize'],
+                                               self.optionsKey)
+            except ValueError as e:
+                print('Warning! %s, -sharedcache is not used.' %(e))
+
+    def UciToSanMove(self, pos, uciMove, board=None):
+        """ Returns san move given uci move. The san is memoized on the
+            position without move counters and the move, if board of pos
+            is already available it is used instead of creating a new one.
+        """
+        key = (pos.rsplit(' ', 2)[0], uciMove)
+        sanMove = self.sanCache.get(key)
+        if sanMove is not None:
+            return sanMove
+
+        if board is None:
+            board = chess.Board(pos)
+        sanMove = board.san(chess.Move.from_uci(uciMove))
 
-    def UciToSanMove(self, pos, uciMove):
-        """ Returns san move given uci move """
-        board = chess.Board(pos)
-        board.push(chess.Move.from_uci(uciMove))
-        sanMove = board.san(board.pop())
+        # Don't let the cache grow without limit on big pgn files.
+        if len(self.sanCache) >= SAN_CACHE_SIZE:
+            self.sanCache.clear()
+        self.sanCache[key] = sanMove
         return sanMove
 
+    def GetPvLineSan(self, pvLine):
+        """ Returns the pv line in san format, pvLine is a pair of
+            position and the list of uci moves from the engine.
+        """
+        pos, pvMoves = pvLine
+        try:
+            board = chess.Board(pos)
+            pvLineSan = \
+                board.variation_san([chess.Move.from_uci(m) for m in pvMoves])
+        except:
+            print('Warning, there is error in pvLine')
+            print('pvLine: %s' %(pvMoves))
+            pvLineSan = ' '.join(pvMoves)
+        return pvLineSan
+
     def PrintEngineIdName(self):
         """ Prints engine id name """
         print('Analyzing engine: %s' %(self.engIdName))
@@ -535,6 +995,11 @@ class Analyze():
             self.WriteSanMove(side, fmvn, sanMove)
             return
 
+        # Convert the engine pv to san only when it will be written, that is
+        # when the game move is not the same as the engine best move.
+        if engMove is not None and sanMove != engMove:
+            pvLine = self.GetPvLineSan(pvLine)
+
         # (1) Write sanMove, posScore
         isWritePosScore = posScore is not None and\
                        bookMove is None and\
@@ -616,33 +1081,121 @@ class Analyze():
             black material. Material is calculated based
             on q=9, r=5, b=3, n=3
         """
-        # Get piece field of fen
-        pieces = fen.split()[0]
-
-        # Count pieces
-        Q = pieces.count('Q')
-        q = pieces.count('q')
-        R = pieces.count('R')
-        r = pieces.count('r')
-        B = pieces.count('B')
-        b = pieces.count('b')
-        N = pieces.count('N')
-        n = pieces.count('n')
-        P = pieces.count('P')
-        p = pieces.count('p')
-
-        # Get piece values except pawns
-        wmat = Q*9 + R*5 + B*3 + N*3
-        bmat = q*9 + r*5 + b*3 + b*3
-
-        # Get queen and pawn counts
-        queens = Q+q
-        pawns = P+p
-        return wmat, bmat, queens, pawns
+        features = self.GetPositionFeatures(chess.BaseBoard(fen.split()[0]))
+        return features['wmat'], features['bmat'],\
+               features['queens'], features['pawns']
+
+    def GetPositionFeatures(self, board):
+        """ Returns a dict of the position inputs used for complexity,
+            white and black material without pawns (q=9, r=5, b=3, n=3),
+            queen and pawn counts and if the center is closed. Everything
+            is counted with popcounts on the bitboards of board.
+        """
+        popcount = chess.popcount
+        white = board.occupied_co[chess.WHITE]
+        black = board.occupied_co[chess.BLACK]
+        minors = board.bishops | board.knights
+
+        features = {}
+        features['wmat'] = 9*popcount(board.queens & white) +\
+                           5*popcount(board.rooks & white) +\
+                           3*popcount(minors & white)
+        features['bmat'] = 9*popcount(board.queens & black) +\
+                           5*popcount(board.rooks & black) +\
+                           3*popcount(minors & black)
+        features['queens'] = popcount(board.queens)
+        features['pawns'] = popcount(board.pawns)
+
+        # Case 1: wpawn at e5/d4 and bpawn at d5/e6 pattern
+        # Case 2: wpawn at d5/e4 and bpawn at d6/e5 pattern
+        wpawns = board.pawns & white
+        bpawns = board.pawns & black
+        wcase1, bcase1 = chess.BB_E5 | chess.BB_D4, chess.BB_D5 | chess.BB_E6
+        wcase2, bcase2 = chess.BB_D5 | chess.BB_E4, chess.BB_D6 | chess.BB_E5
+        features['closed'] = \
+            (wpawns & wcase1 == wcase1 and bpawns & bcase1 == bcase1) or\
+            (wpawns & wcase2 == wcase2 and bpawns & bcase2 == bcase2)
+        return features
+
+    def GetGameFeatures(self, game):
+        """ Returns a list of position features, one for each position
+            in the main line of game including the final position. It is
+            done for the whole game at once before the engine is started.
+        """
+        gameFeatures = []
+        board = game.board()
+        for move in game.main_line():
+            gameFeatures.append(self.GetPositionFeatures(board))
+            board.push(move)
+        gameFeatures.append(self.GetPositionFeatures(board))
+        return gameFeatures
+
+    def GetAllocatedMoveTime(self, features):
+        """ Returns the movetime for the position given its features.
+            When -timealloc is complexity, positions with queens or
+            with lots of material and open center get more time and
+            closed or simplified positions get less, within 0.5x to 1.5x
+            of -movetime.
+        """
+        if self.timeAllocOpt != 'complexity' or features is None:
+            return self.moveTimeOpt
+
+        factor = 1.0
+        if features['queens'] > 0:
+            factor += 0.25
+        if features['wmat'] + features['bmat'] >= 46 and\
+           features['pawns'] <= 14:
+            factor += 0.25
+        if features['closed']:
+            factor -= 0.25
+        if features['wmat'] + features['bmat'] <= 26:
+            factor -= 0.25
+        factor = min(1.5, max(0.5, factor))
+        return int(self.moveTimeOpt * factor)
     
-    def GetEngineIdName(self):
-        """ Returns the engine id name """
-        engineIdName = self.eng[0:-4]
+    def GetEngineProbe(self):
+        """ Returns the id name, the options and their defaults and the
+            eval command support of the engine. The probe is saved in
+            ENGINE_PROBE_FILE by engine path, size and modification time,
+            the engine is only run when it is not yet probed or changed.
+        """
+        path = os.path.abspath(self.eng)
+        st = os.stat(path)
+        probes = {}
+        try:
+            with open(ENGINE_PROBE_FILE, 'r') as f:
+                probes = json.load(f)
+        except:
+            pass
+        probe = probes.get(path)
+        if probe is not None and probe['size'] == st.st_size\
+           and probe['mtime'] == st.st_mtime:
+            return probe
+
+        probe = self.ProbeEngine()
+        probe['size'], probe['mtime'] = st.st_size, st.st_mtime
+        probes[path] = probe
+
+        # Other processes may probe at the same time, replace the file.
+        try:
+            tmpFile = '%s.%d' %(ENGINE_PROBE_FILE, os.getpid())
+            with open(tmpFile, 'w') as f:
+                json.dump(probes, f, indent=1, sort_keys=True)
+            if os.name == 'nt':
+                DeleteFile(ENGINE_PROBE_FILE)
+            os.rename(tmpFile, ENGINE_PROBE_FILE)
+        except:
+            print('Warning! engine probe is not saved in %s'\
+                  %(ENGINE_PROBE_FILE))
+        return probe
+
+    def ProbeEngine(self):
+        """ Returns the id name, the options and their defaults and the
+            eval command support of the engine by running it.
+        """
+        # Use the filename without extension if there is no id name.
+        probe = {'idName': os.path.splitext(os.path.basename(self.eng))[0],
+                 'options': {}, 'eval': False}
 
         # Run the engine
         p = subprocess.Popen(self.eng, stdin=subprocess.PIPE,
@@ -656,18 +1209,67 @@ class Analyze():
             line = eline.strip()
 
             # Save id name.
-            if 'id name ' in line:
+            if line.startswith('id name '):
                 idName = line.split()
-                engineIdName = ' '.join(idName[2:])            
+                probe['idName'] = ' '.join(idName[2:])
+
+            # Save option name, type and default,
+            # option name Hash type spin default 16 min 1 max 1024
+            if line.startswith('option name ') and ' type ' in line:
+                name, rest = line[len('option name '):].split(' type ', 1)
+                optType = rest.split()[0]
+                default = None
+                if ' default ' in ' ' + rest:
+                    default = (' ' + rest).split(' default ', 1)[1]
+                    for k in [' min ', ' max ', ' var ']:
+                        default = default.split(k)[0]
+                probe['options'][name.strip()] = {'type': optType,
+                                                  'default': default}
             if "uciok" in line:           
                 break
+
+        # Check that the eval command is supported.
+        p.stdin.write("isready\n")
+        p.stdin.write("position startpos\n")
+        p.stdin.write("eval\n")
+        p.stdin.write("isready\n")
+        readyCnt = 0
+        for eline in iter(p.stdout.readline, ''):
+            line = eline.strip()
+            if 'Total Evaluation: ' in line:
+                probe['eval'] = True
+            if "readyok" in line:
+                readyCnt += 1
+                if readyCnt == 2:
+                    break
                 
         # Quit the engine
         p.stdin.write('quit\n')
         p.communicate()
-        return engineIdName
+        return probe
+
+    def GetSearchNodesToDepth(self, pos, depth):
+        """ Returns the nodes searched by the engine to depth in pos """
+        nodes = 0
+        p = self.StartEngine()
+        p.stdin.write("ucinewgame\n")
+        p.stdin.write(self.GetPositionCommand(pos) + "\n")
+        p.stdin.write("go depth %d\n" %(depth))
+        for eline in iter(p.stdout.readline, ''):
+            line = eline.strip()
+            if ' nodes ' in line:
+                splitStr = line.split()
+                nodes = int(splitStr[splitStr.index('nodes') + 1])
+            if 'bestmove ' in line:
+                break
+        self.StopEngine(p)
+        return nodes
 
-    def GetCerebellumBookMove(self, pos):
+    def IsEngineOption(self, optionName):
+        """ Returns True if the engine has uci option optionName """
+        return optionName in self.engineProbe['options']
+
+    def GetCerebellumBookMove(self, pos, board=None):
         """ Returns a move from cerebellum book """
         isInfoDepth = False
         
@@ -727,15 +1329,23 @@ class Analyze():
         # then the bestmove is from the book.
         if not isInfoDepth:
             # Convert uci move to san move format.
-            bestMove = self.UciToSanMove(pos, bestMove)
+            bestMove = self.UciToSanMove(pos, bestMove, board)
             return bestMove
         return None
 
     def GetEngineOptionValue(self, optionName):
-        """ Returns value str of option given option name """
+        """ Returns value str of option given option name, the default
+            of the engine is returned if the option is not set.
+        """
+        engineDefault = None
+        if self.IsEngineOption(optionName):
+            engineDefault = self.engineProbe['options'][optionName]['default']
+
         engOptionValue = self.engOpt
         if engOptionValue == 'none':
             # Return defaults
+            if engineDefault is not None:
+                return engineDefault
             if 'Hash' in optionName:
                 return str(DEFAULT_HASH)
             elif 'Threads' in optionName:
@@ -753,7 +1363,7 @@ class Analyze():
             if optionName in value:
                 return value.split()[2]
 
-        return None
+        return engineDefault
 
     def SetEngineOptions(self, p, engOptionValue):
         """ Set engine options for uci engines """
@@ -784,11 +1394,14 @@ class Analyze():
             value = engOptionValue.strip()
             p.stdin.write("setoption name %s\n" %(value))
 
-    def GetStaticEvalAfterMove(self, pos):
-        """ Returns static eval by running the engine,
-            setup position pos and send eval command.
+    def StartEngine(self):
+        """ Returns an engine that is ready for a position command. The
+            engine is started for each query, but with -session game the
+            same engine is used from query to query and from game to game.
         """
-        score = TEST_SEARCH_SCORE
+        if self.sessionEngine is not None:
+            self.StopPonder()
+            return self.sessionEngine
 
         # Run the engine.
         p = subprocess.Popen(self.eng, stdin=subprocess.PIPE,
@@ -814,10 +1427,133 @@ class Analyze():
             line = eline.strip()
             if "readyok" in line:
                 break
+
+        p.stdin.write("ucinewgame\n")
+        if self.sessionOpt == 'game':
+            self.sessionEngine = p
+        return p
+
+    def StopEngine(self, p):
+        """ Quits the engine p unless it is the engine of the session """
+        if p is self.sessionEngine:
+            return
+        p.stdin.write('quit\n')
+        p.communicate()
+
+    def StartGameSession(self, game):
+        """ Clears the hash of the session engine and saves the moves
+            of the game. The positions of the game are then sent as the
+            moves from the start of the game, so the engine also knows
+            the positions for repetition and fifty move draws.
+        """
+        board = game.board()
+        self.sessionRoot = board.fen()
+        self.sessionMoves = [m.uci() for m in game.main_line()]
+        self.sessionPositions = {self.sessionRoot: 0}
+        for i, move in enumerate(game.main_line()):
+            board.push(move)
+            self.sessionPositions[board.fen()] = i + 1
+
+        # A new engine has just received ucinewgame. The hash is kept
+        # for the live games of -watch on.
+        if self.sessionEngine is None:
+            self.StartEngine()
+            return
+        if self.watchOpt == 'on':
+            return
+        p = self.sessionEngine
+        p.stdin.write("ucinewgame\n")
+        p.stdin.write("isready\n")
+        for eline in iter(p.stdout.readline, ''):
+            line = eline.strip()
+            if "readyok" in line:
+                break
+
+    def EndGameSession(self):
+        """ Forgets the moves of the game, the engine is kept """
+        self.sessionRoot, self.sessionMoves = None, []
+        self.sessionPositions = {}
+
+    def StartPonder(self, pos):
+        """ Starts an infinite search of pos on the session engine. The
+            pv lines are read in a thread so the engine is not blocked,
+            GetSearchScoreBeforeMove of pos then uses this search.
+        """
+        p = self.StartEngine()
+
+        # The search is used like the searches before the move, with the
+        # MultiPV of -complexity multipv.
+        if self.IsMultiPvComplexity():
+            p.stdin.write("setoption name MultiPV value %d\n"\
+                          %(COMPLEXITY_MULTIPV))
+        p.stdin.write(self.GetPositionCommand(pos) + "\n")
+        p.stdin.write("go infinite\n")
+        self.ponderPos, self.ponderStart = pos, time.time()
+        self.ponderLines = []
+
+        def ReadPonder():
+            for eline in iter(p.stdout.readline, ''):
+                line = eline.strip()
+                if ' pv ' in line or 'bestmove ' in line:
+                    self.ponderLines.append(line)
+                if 'bestmove ' in line:
+                    break
+
+        self.ponderThread = threading.Thread(target=ReadPonder)
+        self.ponderThread.daemon = True
+        self.ponderThread.start()
+
+    def StopPonder(self):
+        """ Stops the infinite search and returns its lines """
+        if self.ponderThread is None:
+            return []
+        self.sessionEngine.stdin.write("stop\n")
+        self.ponderThread.join()
+        if self.IsMultiPvComplexity():
+            self.sessionEngine.stdin.write("setoption name MultiPV value 1\n")
+        self.ponderPos, self.ponderThread = None, None
+        return self.ponderLines
+
+    def IsMultiPvComplexity(self):
+        """ Returns True when the searches before the move are MultiPV
+            searches for -complexity multipv.
+        """
+        return self.jobOpt in ANALYZE_JOBS and\
+               self.complexityOpt == 'multipv'
+
+    def QuitSessionEngine(self):
+        """ Quits the engine of the session """
+        self.StopPonder()
+        if self.sessionEngine is not None:
+            p, self.sessionEngine = self.sessionEngine, None
+            self.StopEngine(p)
+
+    def GetPositionCommand(self, pos):
+        """ Returns the uci position command of pos, in a game session
+            the moves from the start of the game are included.
+        """
+        moveCnt = self.sessionPositions.get(pos)
+        if moveCnt is None:
+            return "position fen " + pos
+        if self.sessionRoot == chess.STARTING_FEN:
+            command = "position startpos"
+        else:
+            command = "position fen " + self.sessionRoot
+        if moveCnt:
+            command += " moves " + ' '.join(self.sessionMoves[:moveCnt])
+        return command
+
+    def GetStaticEvalAfterMove(self, pos):
+        """ Returns static eval by running the engine,
+            setup position pos and send eval command.
+        """
+        score = TEST_SEARCH_SCORE
+
+        # Run the engine or use the engine of the game session.
+        p = self.StartEngine()
                 
         # Send commands to engine.
-        p.stdin.write("ucinewgame\n")
-        p.stdin.write("position fen " + pos + "\n")
+        p.stdin.write(self.GetPositionCommand(pos) + "\n")
         p.stdin.write("eval\n")
 
         # Parse the output and extract the engine static eval.
@@ -828,9 +1564,8 @@ class Analyze():
                 score = float(first.split()[2])
                 break
                 
-        # Quit the engine
-        p.stdin.write('quit\n')
-        p.communicate()
+        # Quit the engine, the engine of the game session is kept.
+        self.StopEngine(p)
         assert score != TEST_SEARCH_SCORE,\
                'Error! something is wrong in static eval calculation.'
         return score
@@ -843,30 +1578,8 @@ class Analyze():
         # Initialize
         bestMove = None
 
-        # Run the engine.
-        p = subprocess.Popen(self.eng, stdin=subprocess.PIPE,
-                             stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-
-        # Send command to engine.
-        p.stdin.write("uci\n")
-
-        # Parse engine replies.
-        for eline in iter(p.stdout.readline, ''):
-            line = eline.strip()
-            if "uciok" in line:
-                break
-
-        # Set engine options
-        self.SetEngineOptions(p, self.engOpt)
-                
-        # Send command to engine.
-        p.stdin.write("isready\n")
-        
-        # Parse engine replies.
-        for eline in iter(p.stdout.readline, ''):
-            line = eline.strip()
-            if "readyok" in line:
-                break
+        # Run the engine or use the engine of the game session.
+        p = self.StartEngine()
 
         # Push null move
         b = chess.Board(pos)
@@ -874,8 +1587,7 @@ class Analyze():
         newPos = b.fen()
         
         # Send commands to engine.
-        p.stdin.write("ucinewgame\n")
-        p.stdin.write("position fen " + newPos + "\n")
+        p.stdin.write(self.GetPositionCommand(newPos) + "\n")
         p.stdin.write("go movetime %d\n" %(self.moveTimeOpt))
 
         # Parse the output and extract the engine search score.
@@ -885,66 +1597,76 @@ class Analyze():
                 bestMove = line.split()[1]
                 break
                 
-        # Quit the engine
-        p.stdin.write('quit\n')
-        p.communicate()
+        # Quit the engine, the engine of the game session is kept.
+        self.StopEngine(p)
 
         # Convert uci move to san move format.
         if bestMove is not None:
-            bestMove = self.UciToSanMove(newPos, bestMove)
+            bestMove = self.UciToSanMove(newPos, bestMove, b)
         
         return bestMove
 
-    def GetSearchScoreBeforeMove(self, pos, side):
-        """ Returns bestmove, pv, score complexity number of the position
-            and root move changes. """
+    def GetSearchScoreBeforeMove(self, pos, side, features=None,
+                                 moveTime=None):
+        """ Returns bestmove, pv, score complexity number of the position,
+            root move changes and the depth, nodes and time of the search.
+        """
 
         # Initialize
         scoreCp = TEST_SEARCH_SCORE
+        searchStats = {'depth': 0, 'nodes': 0, 'time': 0}
+        if moveTime is None:
+            moveTime = self.moveTimeOpt
 
         pvLine = None
         searchDepth = 0
         savedMove = []
         complexityNumber = 0
         moveChanges = 0;
-        isGetComplexityNumber = self.jobOpt == 'analyze' and\
+        isGetComplexityNumber = self.jobOpt in ANALYZE_JOBS and\
                                 self.moveTimeOpt >= COMPLEXITY_MINIMUM_TIME
 
-        # Run the engine.
-        p = subprocess.Popen(self.eng, stdin=subprocess.PIPE,
-                             stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-
-        # Send command to engine.
-        p.stdin.write("uci\n")
-
-        # Parse engine replies.
-        for eline in iter(p.stdout.readline, ''):
-            line = eline.strip()
-            if "uciok" in line:
-                break
-
-        # Set engine options
-        self.SetEngineOptions(p, self.engOpt)
-                
-        # Send command to engine.
-        p.stdin.write("isready\n")
-        
-        # Parse engine replies.
-        for eline in iter(p.stdout.readline, ''):
-            line = eline.strip()
-            if "readyok" in line:
-                break
-                
-        # Send commands to engine.
-        p.stdin.write("ucinewgame\n")
-        p.stdin.write("position fen " + pos + "\n")
-        p.stdin.write("go movetime %d\n" %(self.moveTimeOpt))
+        # The multipv estimator also works at short movetimes.
+        isMultiPv = self.IsMultiPvComplexity()
+        if isMultiPv:
+            isGetComplexityNumber = True
+        pvScores = {}
+
+        # With -watch on, the engine may already be searching pos since
+        # the last update of the game, it gets at least moveTime.
+        if self.ponderThread is not None and self.ponderPos == pos:
+            p = self.sessionEngine
+            elapsed = (time.time() - self.ponderStart) * 1000
+            if elapsed < moveTime:
+                time.sleep((moveTime - elapsed) / 1000.0)
+            lines = self.StopPonder()
+            isMultiPvSet = False
+        else:
+            # Run the engine or use the engine of the game session.
+            p = self.StartEngine()
+
+            # Send commands to engine.
+            isMultiPvSet = isMultiPv
+            if isMultiPv:
+                p.stdin.write("setoption name MultiPV value %d\n"\
+                              %(COMPLEXITY_MULTIPV))
+            p.stdin.write(self.GetPositionCommand(pos) + "\n")
+            p.stdin.write("go movetime %d\n" %(moveTime))
+            lines = iter(p.stdout.readline, '')
 
         # Parse the output and extract the engine search score.
-        for eline in iter(p.stdout.readline, ''):        
+        for eline in lines:
             line = eline.strip()                
 
-            # Save pv move per depth
+            # Save the last score of the other pvs of -complexity multipv.
+            if ' multipv ' in line and not ' multipv 1 ' in line:
+                splitLine = line.split()
+                multiPv = int(splitLine[splitLine.index('multipv')+1])
+                if 'upperbound' not in line and 'lowerbound' not in line:
+                    pvScores[multiPv] = self.GetInfoScore(splitLine)
+                continue
+
+            # Save pv move and score per depth
             if isGetComplexityNumber:
                 if 'info depth ' in line and 'pv ' in line and not\
                    'upperbound' in line and not 'lowerbound' in line:
@@ -955,7 +1677,8 @@ class Analyze():
 
                     # Get the move and save it
                     pvMove = splitLine[splitLine.index('pv')+1].strip()
-                    savedMove.append([searchDepth, pvMove])
+                    savedMove.append([searchDepth, pvMove,
+                                      self.GetInfoScore(splitLine)])
 
             # Save pv line
             if 'info depth ' in line and 'pv ' in line and not\
@@ -963,6 +1686,13 @@ class Analyze():
                 splitLine = line.split()
                 pvIndex = splitLine.index('pv')
                 pvLine = splitLine[pvIndex+1:pvIndex+6]
+
+            # Save search stats
+            if 'info depth ' in line and ' nodes ' in line:
+                splitLine = line.split()
+                for k in ['depth', 'nodes', 'time']:
+                    if k in splitLine:
+                        searchStats[k] = int(splitLine[splitLine.index(k)+1])
                     
             if 'score cp ' in line:
                 splitStr = line.split()
@@ -981,9 +1711,11 @@ class Analyze():
                 bestMove = line.split()[1]
                 break
                 
-        # Quit the engine
-        p.stdin.write('quit\n')
-        p.communicate()        
+        # Quit the engine, the engine of the game session is kept.
+        # StopPonder has set MultiPV back already.
+        if isMultiPvSet:
+            p.stdin.write("setoption name MultiPV value 1\n")
+        self.StopEngine(p)        
         assert scoreCp != TEST_SEARCH_SCORE, 'Error, search failed to return a score.'
 
         # Get the first move of the pvLine, make sure the this move
@@ -993,19 +1725,20 @@ class Analyze():
             pvLine = []
             pvLine.append(bestMove)
 
-        # Convert pv line to SAN
-        try:
-            board = chess.Board(pos)
-            pvLineSan = \
-                board.variation_san([chess.Move.from_uci(m) for m in pvLine])
-        except:
-            print('Warning, there is error in pvLine')
-            print('pvLine: %s' %(pvLine))
+        # The pv line is converted to SAN later, only when it is written.
+        pvLine = (pos, pvLine)
 
         # Get complexity number and moveChanges count
         if isGetComplexityNumber:
-            complexityNumber, moveChanges =\
-                              self.GetComplexityNumber(savedMove, pos)
+            if features is None:
+                features = self.GetPositionFeatures(chess.Board(pos))
+            if isMultiPv:
+                complexityNumber, moveChanges =\
+                    self.GetMultiPvComplexityNumber(savedMove, pvScores,
+                                                    features)
+            else:
+                complexityNumber, moveChanges =\
+                    self.GetComplexityNumber(savedMove, features)
 
         # Convert uci move to san move format.
         bestMove = self.UciToSanMove(pos, bestMove)
@@ -1016,9 +1749,21 @@ class Analyze():
 
         # Convert the score to pawn unit in float type
         scoreP = float(scoreCp)/100.0
-        return bestMove, scoreP, complexityNumber, moveChanges, pvLineSan
+        return bestMove, scoreP, complexityNumber, moveChanges, pvLine,\
+               searchStats
 
-    def GetComplexityNumber(self, savedMove, fen):
+    def GetInfoScore(self, splitLine):
+        """ Returns the score of a split info line in cp, a mate score is
+            converted to a value. It is None without a score.
+        """
+        if 'score' not in splitLine:
+            return None
+        scoreIndex = splitLine.index('score')
+        if splitLine[scoreIndex + 1] == 'mate':
+            return self.MateDistanceToValue(int(splitLine[scoreIndex + 2]))
+        return int(splitLine[scoreIndex + 2])
+
+    def GetComplexityNumber(self, savedMove, features):
         """ Returns complexity number and move changes counts """
         complexityNumber, moveChanges = 0, 0
         for n in savedMove:
@@ -1029,22 +1774,65 @@ class Analyze():
                     moveChanges += 1
             lastDepth = depth
             lastMove = n[1]
+        complexityNumber = self.AdjustComplexityNumber(complexityNumber,
+                                                       features)
+        return complexityNumber, moveChanges
+
+    def GetMultiPvComplexityNumber(self, savedMove, pvScores, features):
+        """ Returns complexity number and move changes counts of a short
+            multipv search. Move changes are the changes of the best move
+            from depth COMPLEXITY_MULTIPV_DEPTH. The complexity number
+            adds the score changes of the best move across depths, the
+            gap from the best move to the second best move and 5 for
+            each other move within DRAW_SCORE of the best move.
+        """
+        moveChanges, volatility = 0, 0
+        lastMove, lastScore = None, None
+        for depth, move, score in savedMove:
+            if depth < COMPLEXITY_MULTIPV_DEPTH or score is None:
+                continue
+            if lastMove is not None and move != lastMove:
+                moveChanges += 1
+            if lastScore is not None:
+                volatility += abs(score - lastScore)
+            lastMove, lastScore = move, score
+        if lastScore is None:
+            return 0, 0
+
+        # The other pvs, the gap is 0 when there is only one legal move.
+        scores = [s for s in pvScores.values() if s is not None]
+        gap = 0
+        if scores:
+            gap = max(0, lastScore - max(scores))
+        nearMoves = len([s for s in scores
+                         if lastScore - s <= 100 * DRAW_SCORE])
+
+        complexityNumber = min(volatility, COMPLEXITY_MULTIPV_LIMIT) / 10\
+                           + min(gap, COMPLEXITY_MULTIPV_LIMIT) / 10\
+                           + 5 * nearMoves
+        complexityNumber = self.AdjustComplexityNumber(complexityNumber,
+                                                       features)
+        return complexityNumber, moveChanges
 
+    def AdjustComplexityNumber(self, complexityNumber, features):
+        """ Returns the complexity number adjusted by the material and the
+            center of the position.
+        """
         # Increase complexityNumber when there are queens, and high mat values
         if complexityNumber:
-            wmat, bmat, queens, pawns = self.GetMaterialInfo(fen)
-            if queens > 0:
+            if features['queens'] > 0:
                 complexityNumber += 5
-            if wmat + bmat >= 46 and pawns <= 14:
+            if features['wmat'] + features['bmat'] >= 46 and\
+               features['pawns'] <= 14:
                 complexityNumber += 5
 
         # Reduce complexity number when center is closed
-        if self.IsCenterClosed(fen):
+        if features['closed']:
             complexityNumber -= 10
             if complexityNumber < 0:
                 complexityNumber = 0
                 
-        return complexityNumber, moveChanges
+        return complexityNumber
 
     def IsCenterClosed(self, fen):
         """ Given fen check if center is closed. Center is closed
@@ -1052,92 +1840,23 @@ class Analyze():
             black pawns at e6 and d5 or there are white pawns in
             e4 and d5 and there are black pawns at d6 and e5. """
         bb = chess.BaseBoard(fen.split()[0])
+        return self.GetPositionFeatures(bb)['closed']
 
-        # Case 1: wpawn at e5/d4 and bpawn at d5/e6 pattern
-        
-        # Find wpawn at e5/d4
-        e5Found, d4Found = False, False
-        wpSqList = bb.pieces(chess.PAWN, chess.WHITE)
-        if chess.E5 in wpSqList:
-            e5Found = True
-        if chess.D4 in wpSqList:
-            d4Found = True
-
-        # We only check the black pattern when we found the white pattern
-        # Find bpawn at d5/e6
-        if e5Found and d4Found:
-            d5Found, e6Found = False, False
-            bpSqList = bb.pieces(chess.PAWN, chess.BLACK)
-            if chess.D5 in bpSqList:
-                d5Found = True
-            if chess.E6 in bpSqList:
-                e6Found = True
-
-            # Return early if we found a pattern
-            if d5Found and e6Found:
-                return True
-
-        # Case 2: wpawn at d5/e4 and bpawn at d6/e5 pattern
-
-        # Find wpawn at d5/e4
-        d5Found, e4Found = False, False
-        wpSqList = bb.pieces(chess.PAWN, chess.WHITE)
-        if chess.D5 in wpSqList:
-            d5Found = True
-        if chess.E4 in wpSqList:
-            e4Found = True
-
-        # We only check the black pattern when we found the white pattern
-        # Find bpawn at d6/e5
-        if d5Found and e4Found:
-            d6Found, e5Found = False, False
-            bpSqList = bb.pieces(chess.PAWN, chess.BLACK)
-            if chess.D6 in bpSqList:
-                d6Found = True
-            if chess.E5 in bpSqList:
-                e5Found = True
-
-            if d6Found and e5Found:
-                return True
-                
-        return False
-
-    def GetSearchScoreAfterMove(self, pos, side):
+    def GetSearchScoreAfterMove(self, pos, side, moveTime=None):
         """ Returns search's score, complexity number and
             pv move changes counts.
         """
         # Initialize
         scoreCp = TEST_SEARCH_SCORE
+        if moveTime is None:
+            moveTime = self.moveTimeOpt
 
-        # Run the engine.
-        p = subprocess.Popen(self.eng, stdin=subprocess.PIPE,
-                             stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-
-        # Send command to engine.
-        p.stdin.write("uci\n")
-
-        # Parse engine replies.
-        for eline in iter(p.stdout.readline, ''):
-            line = eline.strip()
-            if "uciok" in line:
-                break
-
-        # Set engine options
-        self.SetEngineOptions(p, self.engOpt)
-                
-        # Send command to engine.
-        p.stdin.write("isready\n")
-        
-        # Parse engine replies.
-        for eline in iter(p.stdout.readline, ''):
-            line = eline.strip()
-            if "readyok" in line:
-                break
+        # Run the engine or use the engine of the game session.
+        p = self.StartEngine()
                 
         # Send commands to engine.
-        p.stdin.write("ucinewgame\n")
-        p.stdin.write("position fen " + pos + "\n")
-        p.stdin.write("go movetime %d\n" %(self.moveTimeOpt))
+        p.stdin.write(self.GetPositionCommand(pos) + "\n")
+        p.stdin.write("go movetime %d\n" %(moveTime))
 
         # Parse the output and extract the engine search score.
         for eline in iter(p.stdout.readline, ''):        
@@ -1158,9 +1877,8 @@ class Analyze():
             if 'bestmove ' in line:
                 break
                 
-        # Quit the engine
-        p.stdin.write('quit\n')
-        p.communicate()        
+        # Quit the engine, the engine of the game session is kept.
+        self.StopEngine(p)        
         assert scoreCp != TEST_SEARCH_SCORE, 'Error, search failed to return a score.'
             
         # Invert the score sign because we analyze the position after the move.
@@ -1174,8 +1892,12 @@ class Analyze():
         scoreP = float(scoreCp)/100.0
         return scoreP
 
-    def GetEpdEngineSearchScore(self, pos):
-        """ Returns acd, acs, bm, ce and Ae opcodes. """
+    def GetEpdEngineSearchScore(self, pos, moveTime=None, stats=None):
+        """ Returns acd, acs, bm, ce and Ae opcodes. The last nodes
+            and nps of the search are saved in the stats dict if given.
+        """
+        if moveTime is None:
+            moveTime = self.moveTimeOpt
 
         # Initialize
         bestMove = None
@@ -1210,7 +1932,7 @@ class Analyze():
         # Send commands to engine.
         p.stdin.write("ucinewgame\n")
         p.stdin.write("position fen " + pos + "\n")
-        p.stdin.write("go movetime %d\n" %(self.moveTimeOpt))
+        p.stdin.write("go movetime %d\n" %(moveTime))
 
         # Parse the output and extract the engine search, depth and bestmove
         for eline in iter(p.stdout.readline, ''):        
@@ -1230,6 +1952,11 @@ class Analyze():
                 splitStr = line.split()
                 depthIndex = splitStr.index('depth')
                 depthSearched = int(splitStr[depthIndex + 1])                     
+            if stats is not None and ' nodes ' in line:
+                splitStr = line.split()
+                stats['nodes'] = int(splitStr[splitStr.index('nodes') + 1])
+                if 'nps' in splitStr:
+                    stats['nps'] = int(splitStr[splitStr.index('nps') + 1])
 
             # Break search when we receive bestmove
             if 'bestmove ' in line:
@@ -1247,7 +1974,7 @@ class Analyze():
         assert depthSearched != TEST_SEARCH_DEPTH, 'Error the engine does not search at all.'
         assert scoreCp != TEST_SEARCH_SCORE, 'Error!, search failed to return a score.'
         assert bestMove is not None, 'Error! seach failed to return a move.'
-        return depthSearched, self.moveTimeOpt/1000, bestMove, scoreCp
+        return depthSearched, moveTime/1000, bestMove, scoreCp
 
     def GetEpdEngineStaticScore(self, pos):
         """ Returns ce and Ae opcodes. """
@@ -1311,27 +2038,125 @@ class Analyze():
         scoreCp = int(scoreP * 100.0)
         return scoreCp
 
-    def WriteTerminationMarker(self, wcnt, bcnt, werr, berr, rdiff, res):
-        """ Write termination marker and average errror """
-        if wcnt and bcnt:
-            with open(self.outfn, 'a') as f:
-                f.write('(-- {WhiteAveError=%0.2f, BlackAveError=%0.2f, ratingDiff=%d}) %s\n\n'\
-                        %(werr, berr, rdiff, res))
-        else:
-            with open(self.outfn, 'a') as f:
-                f.write('%s\n\n' %(res)) 
+    def IsSolvedMove(self, move, epdBm, epdAm):
+        """ Returns True if move is one of the bm or is not one of the am """
+        if epdBm:
+            return move in epdBm
+        return move not in epdAm
+
+    def GetEpdSolveTime(self, pos, epdBm, epdAm):
+        """ Returns the solve time in ms, solve depth, bestmove, depth
+            searched and the search time in ms. The search is stopped
+            when the first move of the pv solves the position for
+            stableDepthOpt depths in a row. The solve time and depth are
+            None when the bestmove does not solve the position.
+        """
+        solveTime, solveDepth, stableCnt = None, None, 0
+        lastDepth, depthSearched, bestMove = 0, 0, None
+        isStopped = False
 
-    def WinPercentage(self, pa):
-        """ Returns win percentage given pawn advantage, pa """
-        y = -pa/4.0
-        wp = 1.0/(1.0 + (10**y))
-        return wp
+        # Run the engine.
+        p = subprocess.Popen(self.eng, stdin=subprocess.PIPE,
+                             stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
 
-    def GetRatingDiff(self, averageError):
-        """ Returns rating difference,
-            wp = 1/(1+10**m)
-            wp x (1+10**m) = 1
-            wp + wp x 10**m = 1
+        # Send command to engine.
+        p.stdin.write("uci\n")
+
+        # Parse engine replies.
+        for eline in iter(p.stdout.readline, ''):
+            line = eline.strip()               
+            if "uciok" in line:
+                break
+
+        # Set engine options
+        self.SetEngineOptions(p, self.engOpt)
+                
+        # Send command to engine.
+        p.stdin.write("isready\n")
+        
+        # Parse engine replies.
+        for eline in iter(p.stdout.readline, ''):
+            line = eline.strip()
+            if "readyok" in line:
+                break
+                
+        # Send commands to engine.
+        p.stdin.write("ucinewgame\n")
+        p.stdin.write("position fen " + pos + "\n")
+        p.stdin.write("go movetime %d\n" %(self.moveTimeOpt))
+        startTime = time.time()
+
+        # Watch the first move of the pv at each depth.
+        for eline in iter(p.stdout.readline, ''):        
+            line = eline.strip()
+            if 'bestmove ' in line:
+                bestMove = line.split()[1]
+                break
+            if ' pv ' not in line or ' depth ' not in ' ' + line:
+                continue
+
+            # A pv of a fail high or fail low search is not final.
+            if 'lowerbound' in line or 'upperbound' in line:
+                continue
+            splitStr = line.split()
+            if 'multipv' in splitStr and\
+               splitStr[splitStr.index('multipv') + 1] != '1':
+                continue
+            depth = int(splitStr[splitStr.index('depth') + 1])
+            depthSearched = max(depthSearched, depth)
+            if 'time' in splitStr:
+                elapsed = int(splitStr[splitStr.index('time') + 1])
+            else:
+                elapsed = int(1000 * (time.time() - startTime))
+            pvMove = self.UciToSanMove(pos, splitStr[splitStr.index('pv') + 1])
+
+            # The solution should stay the first move of the pv.
+            if not self.IsSolvedMove(pvMove, epdBm, epdAm):
+                solveTime, solveDepth, stableCnt = None, None, 0
+            elif solveDepth is None:
+                solveTime, solveDepth, stableCnt = elapsed, depth, 1
+            elif depth > lastDepth:
+                stableCnt += 1
+            lastDepth = depth
+
+            # Stop the search, we only wait for the bestmove.
+            if stableCnt >= self.stableDepthOpt and not isStopped:
+                p.stdin.write('stop\n')
+                isStopped = True
+        searchTime = int(1000 * (time.time() - startTime))
+                
+        # Quit the engine
+        p.stdin.write('quit\n')
+        p.communicate()
+
+        # Verify values to be returned
+        assert bestMove is not None, 'Error! seach failed to return a move.'
+        bestMove = self.UciToSanMove(pos, bestMove)
+        if not self.IsSolvedMove(bestMove, epdBm, epdAm):
+            solveTime, solveDepth = None, None
+        return solveTime, solveDepth, bestMove, depthSearched, searchTime
+
+    def WriteTerminationMarker(self, wcnt, bcnt, werr, berr, rdiff, res):
+        """ Write termination marker and average errror """
+        if wcnt and bcnt:
+            with open(self.outfn, 'a') as f:
+                f.write('(-- {WhiteAveError=%0.2f, BlackAveError=%0.2f, ratingDiff=%d}) %s\n\n'\
+                        %(werr, berr, rdiff, res))
+        else:
+            with open(self.outfn, 'a') as f:
+                f.write('%s\n\n' %(res)) 
+
+    def WinPercentage(self, pa):
+        """ Returns win percentage given pawn advantage, pa """
+        y = -pa/4.0
+        wp = 1.0/(1.0 + (10**y))
+        return wp
+
+    def GetRatingDiff(self, averageError):
+        """ Returns rating difference,
+            wp = 1/(1+10**m)
+            wp x (1+10**m) = 1
+            wp + wp x 10**m = 1
             10**m = (1-wp)/wp
             m x log(10) = log((1-wp)/wp)
             log(10) = 1
@@ -1344,266 +2169,1200 @@ class Analyze():
         ratingDiff = 400 * m
         return int(ratingDiff)
     
-    def AnnotatePgn(self):
-        """ Parse the pgn file and annotate the games """
+    def ReadGameTexts(self):
+        """ Yields the fingerprint and the text of the games in the input
+            pgn file. The file is memory mapped and only the text of the
+            game being read is copied. The fingerprint is the sha1 of the
+            tags and the movetext. The games that are not selected by
+            -filter are skipped from their tags.
+        """
+        data = MapFile(self.infn)
+        if not data:
+            return
+        try:
+            for start, end in GetPgnGameOffsets(data):
+                if self.gameFilter:
+                    tags, pos = ReadPgnTags(data, start, end)
+                    if not IsGameSelected(self.gameFilter, tags):
+                        continue
+                text = data[start:end]
+                yield hashlib.sha1(text.strip()).hexdigest(), text
+        finally:
+            data.close()
+
+    def ReadGames(self):
+        """ Yields the games in the input pgn file, the unchanged games
+            of -incremental are skipped.
+        """
+        for fingerprint, text in self.ReadGameTexts():
+            if fingerprint in self.unchangedGames:
+                continue
+            game = ReadMainLineGame(text)
+            if game:
+                yield game
+
+    def ReadManifest(self):
+        """ Returns the games in the output file by fingerprint, the
+            offset and length of their annotation. The manifest is not
+            used when the options or the output file have changed.
+        """
+        manifestFile = self.outfn + '.manifest'
+        if not os.path.isfile(manifestFile) or not os.path.isfile(self.outfn):
+            return {}
+        games = {}
+        with open(manifestFile, 'r') as f:
+            optionsKey, outputSize = f.readline().split()
+            if optionsKey != self.optionsKey or\
+               int(outputSize) != os.path.getsize(self.outfn):
+                print('Manifest of %s is not valid, all games are annotated.'\
+                      %(self.outfn))
+                return {}
+            for line in f:
+                fingerprint, offset, length = line.split()
+                games[fingerprint] = (int(offset), int(length))
+        return games
+
+    def AnnotateChangedGames(self):
+        """ Annotates the new and changed games of -incremental. The
+            annotation of the unchanged games is copied from the previous
+            output file, and the manifest is written for the next run.
+        """
+        outfn = self.outfn
+        tmpFile = outfn + '.tmp'
+        DeleteFile(tmpFile)
+        oldData = ''
+        if self.unchangedGames:
+            oldData = MapFile(outfn)
+        self.outfn = tmpFile
+
+        entries = []
+        gameCnt, keptCnt = 0, 0
+        for fingerprint, text in self.ReadGameTexts():
+            offset = 0
+            if os.path.isfile(tmpFile):
+                offset = os.path.getsize(tmpFile)
+            if fingerprint in self.unchangedGames:
+                start, length = self.unchangedGames[fingerprint]
+                with open(tmpFile, 'ab') as f:
+                    f.write(oldData[start:start+length])
+                keptCnt += 1
+            else:
+                game = ReadMainLineGame(text)
+                if not game:
+                    continue
+                gameCnt += 1
+
+                # Show progress in console.
+                print('Annotating game %d...' %(gameCnt + keptCnt))
+                self.AnnotateGame(game)
+            size = 0
+            if os.path.isfile(tmpFile):
+                size = os.path.getsize(tmpFile)
+            entries.append((fingerprint, offset, size - offset))
+        if oldData:
+            oldData.close()
+
+        # Replace the output file and save where each game is.
+        self.outfn = outfn
+        if not os.path.isfile(tmpFile):
+            open(tmpFile, 'w').close()
+        DeleteFile(outfn)
+        os.rename(tmpFile, outfn)
+        with open(outfn + '.manifest', 'w') as f:
+            f.write('%s %d\n' %(self.optionsKey, os.path.getsize(outfn)))
+            for entry in entries:
+                f.write('%s %d %d\n' %entry)
+        print('Incremental: %d games annotated, %d games kept'\
+              %(gameCnt, keptCnt))
+
+    def BuildOpeningTree(self):
+        """ Returns the opening tree of the input games, a dict of root
+            nodes by starting fen. A node is a dict with the number of
+            games that reached it and its child nodes by uci move, game
+            moves that share a prefix share the nodes. Only the first
+            OPENING_TREE_PLIES moves are added.
+        """
+        tree = {}
+        for game in self.ReadGames():
+            board = game.board()
+            node = tree.setdefault(board.fen(), {'count': 0, 'moves': {}})
+            node['count'] += 1
+            for i, move in enumerate(game.main_line()):
+                if i >= OPENING_TREE_PLIES:
+                    break
+                node = node['moves'].setdefault(move.uci(),
+                                                {'count': 0, 'moves': {}})
+                node['count'] += 1
+        return tree
+
+    def GetOpeningTreeInfo(self, tree):
+        """ Returns number of nodes and theory nodes of the tree """
+        nodeCnt, theoryCnt = 0, 0
+        nodes = list(tree.values())
+        while nodes:
+            node = nodes.pop()
+            nodeCnt += 1
+            if self.theoryOpt and node['count'] >= self.theoryOpt:
+                theoryCnt += 1
+            nodes.extend(node['moves'].values())
+        return nodeCnt, theoryCnt
+
+    def GetGamePlies(self, game):
+        """ Returns a list of dict, one for each move in the main line of
+            game with the data that is needed to analyze and write it.
+            The board is updated move by move, gameNode.board() would
+            replay the game each time. If there is an opening tree, the
+            plies get the tree nodes of the positions before and after
+            the move.
+        """
+        plies = []
+        gameFeatures = self.GetGameFeatures(game)
+        board = game.board()
+        repetitions = {}
+        node = None
+        if self.openingTree is not None:
+            node = self.openingTree.get(board.fen())
+
+        # The start position counts for a threefold repetition too.
+        if self.triageOpt == 'on':
+            repetitions[board.fen().rsplit(' ', 2)[0]] = 1
+        for move in game.main_line():
+            p = {}
+            p['nodeBeforeMove'] = node
+            if node is not None:
+                node = node['moves'].get(move.uci())
+            p['nodeAfterMove'] = node
+
+            # The move is theory when enough games have played it,
+            # otherwise the -movestart rule is used.
+            if self.theoryOpt:
+                p['isTheory'] = node is not None and\
+                                node['count'] >= self.theoryOpt
+            else:
+                p['isTheory'] = board.fullmove_number < self.moveStartOpt
+            p['side'] = board.turn
+            p['fmvn'] = board.fullmove_number
+            p['sanMove'] = board.san(move)
+            p['fenBeforeMove'] = board.fen()
+            p['isCheck'] = board.is_check()
+            p['features'] = gameFeatures[len(plies)]
+            p['featuresAfterMove'] = gameFeatures[len(plies) + 1]
+            p['uciMove'] = move.uci()
+            if self.triageOpt == 'on':
+                p['legalMoveCnt'] = board.legal_moves.count()
+                p['isDrawBeforeMove'] = board.is_insufficient_material()
+            board.push(move)
+            p['fenAfterMove'] = board.fen()
+            p['isGameOver'] = board.is_checkmate() or board.is_stalemate()
+
+            # Count the positions since the last capture or pawn move
+            # to find threefold repetitions.
+            if self.triageOpt == 'on':
+                if board.halfmove_clock == 0:
+                    repetitions = {}
+                key = p['fenAfterMove'].rsplit(' ', 2)[0]
+                repetitions[key] = repetitions.get(key, 0) + 1
+                p['isDrawAfterMove'] = not p['isGameOver'] and\
+                    (board.is_insufficient_material() or\
+                     board.halfmove_clock >= 100 or repetitions[key] >= 3)
+            plies.append(p)
+        return plies
+
+    def GetAnalysis(self, kind, node, pos, func, *args):
+        """ Returns func(pos, *args). If the analysis cache is enabled
+            the result is saved by kind and position without the move
+            number, so that a position is analyzed only once. In planning
+            mode a missing result is only collected in pendingAnalysis and
+            ANALYSIS_PENDING is returned. Without the analysis cache, the
+            result is saved in the opening tree node of pos when other
+            games share it.
+        """
+        # The results of the other processes are in the shared cache.
+        if self.sharedCache is not None and kind in SHARED_CACHE_KINDS:
+            func = self.GetSharedCacheFunc(kind, func)
+
+        if self.analysisCache is None:
+            if node is None or node['count'] < 2:
+                return func(pos, *args)
+            if kind in node:
+                self.treeHits += 1
+                return node[kind]
+            node[kind] = func(pos, *args)
+            return node[kind]
+
+        key = (kind, pos.rsplit(' ', 1)[0])
+        if not self.isPlanning:
+            self.analysisQueries[kind] = self.analysisQueries.get(kind, 0) + 1
+        if key in self.analysisCache:
+            return self.analysisCache[key]
+
+        if self.isPlanning:
+            if key not in self.pendingAnalysis:
+                self.pendingAnalysis[key] = (func, pos, args,
+                                             len(self.pendingAnalysis))
+            return ANALYSIS_PENDING
+
+        result = func(pos, *args)
+        self.analysisCache[key] = result
+        return result
+
+    def GetSharedCacheFunc(self, kind, func):
+        """ Returns a func that looks up the shared cache first and saves
+            the result of func in it. The movetime is the last argument
+            of the search queries.
+        """
+        def SharedCacheFunc(pos, *args):
+            moveTime = 0
+            if kind != 'static':
+                moveTime = args[-1]
+            key = self.sharedCache.GetKey(kind, pos, moveTime)
+            record = self.sharedCache.Get(key)
+            if record is not None:
+                score = float(record[0])/100.0
+                if not kind.endswith('before'):
+                    return score
+                pvLine = record[6].rstrip('\0').split()
+                return self.UciToSanMove(pos, pvLine[0]), score,\
+                       record[2], record[3], (pos, pvLine),\
+                       {'depth': record[1], 'nodes': record[4],
+                        'time': record[5]}
+
+            result = func(pos, *args)
+            if not kind.endswith('before'):
+                record = (int(round(result * 100)), 0, 0, 0, 0, 0, '')
+            else:
+                stats = result[5]
+                record = (int(round(result[1] * 100)), stats['depth'],
+                          result[2], result[3], stats['nodes'],
+                          stats['time'], ' '.join(result[4][1]))
+            self.sharedCache.Put(key, record)
+            return result
+        return SharedCacheFunc
+
+    def GetGameState(self):
+        """ Returns the dict that AnalyzePly updates from ply to ply """
+        return {'isCereEnd': False, 'decisivePlies': 0,
+                'isMateAnnounced': False,
+                'triageAvoided': 0, 'triageShortened': 0,
+                'scanned': 0, 'rescanned': 0}
+
+    def GetScanTime(self, moveTime):
+        """ Returns the movetime of a -scantime search, it is scaled like
+            the allocated movetime.
+        """
+        if self.moveTimeOpt <= 0:
+            return self.scanTimeOpt
+        return max(1, moveTime * self.scanTimeOpt / self.moveTimeOpt)
+
+    def IsCriticalPly(self, p, a):
+        """ Returns True when the scores of the scan of ply p are near a
+            limit that GetBadNag tests, the -DRAW, -SLIGHT and -MODERATE
+            limits for posScore, these and +MODERATE for engScore, or the
+            0.50 loss. Such a ply is searched again with -movetime.
+        """
+        posScore, engScore = a['posScore'], a['engScore']
+        if posScore is None or engScore is None:
+            return False
+        if not p['side']:
+            posScore, engScore = -posScore, -engScore
+        for limit in [-DRAW_SCORE, -SLIGHT_SCORE, -MODERATE_SCORE]:
+            if abs(posScore - limit) <= SCAN_SCORE_MARGIN:
+                return True
+        for limit in [-DRAW_SCORE, -SLIGHT_SCORE, -MODERATE_SCORE,
+                      MODERATE_SCORE]:
+            if abs(engScore - limit) <= SCAN_SCORE_MARGIN:
+                return True
+        return abs(engScore - posScore - 0.50) <= SCAN_SCORE_MARGIN
+
+    def AnalyzePly(self, p, state):
+        """ Returns the analysis of the ply p in a dict and updates the
+            game state. In planning mode the analysis is None when the
+            rest of the ply depends on a result that is still pending.
+        """
+        a = {'bookMove': None, 'posScore': None, 'isGameOver': False,
+             'engMove': None, 'engScore': None, 'complexityNumber': 0,
+             'moveChanges': 0, 'pvLine': None, 'threatMove': None,
+             'searchStats': None}
+        side, fmvn = p['side'], p['fmvn']
+
+        # With -scantime, the plies are searched with the scan time first.
+        isScan = self.scanTimeOpt > 0
+        scanPrefix = 'scan' if isScan else ''
+        isPosSearched, isEngSearched = False, False
+
+        # (0) Don't start the engine analysis when fmvn is below
+        # moveStart or the move is theory and not using a cerebellum book.
+        if p['isTheory'] and self.bookOpt != 'cerebellum':
+            return a
+
+        # (1) Try to get a cerebellum book move.
+        if self.bookOpt == 'cerebellum' and not state['isCereEnd']:
+            # Use FEN before a move, -pipeline has probed it already.
+            bookFunc = self.GetCerebellumBookMove
+            if 'bookMove' in p:
+                bookFunc = lambda pos: p['bookMove']
+            bookMove = self.GetAnalysis('book', p['nodeBeforeMove'],
+                                        p['fenBeforeMove'], bookFunc)
+
+            # The next book moves and (2) depend on this one, don't plan them.
+            if bookMove is ANALYSIS_PENDING:
+                if fmvn > BOOK_MOVE_LIMIT:
+                    state['isCereEnd'] = True
+                if p['isTheory']:
+                    return None
+                bookMove = None
+            a['bookMove'] = bookMove
+
+            # End trying to find cerebellum book move beyond BOOK_MOVE_LIMIT.
+            if bookMove is None and fmvn > BOOK_MOVE_LIMIT:
+                state['isCereEnd'] = True
+
+        # (2) Don't start the engine analysis when fmvn is below moveStart
+        # or the move is theory.
+        if p['isTheory'] and a['bookMove'] is not None:
+            return a
+
+        # (3) Get the posScore or the score of the player move.
+        # Can be by static eval of the engine or search score of the engine
+        posScore = None
+        if self.evalOpt == 'static':
+            posScore = self.GetAnalysis('static', p['nodeAfterMove'],
+                                        p['fenAfterMove'],
+                                        self.GetStaticEvalAfterMove)
+        elif self.evalOpt == 'search' and self.triageOpt == 'on'\
+             and p['isDrawAfterMove']:
+            # (3.1) Triage, a draw by rule needs no search.
+            posScore = 0.0
+            state['triageAvoided'] += 1
+        elif self.evalOpt == 'search':
+            moveTime = self.GetAllocatedMoveTime(p['featuresAfterMove'])
+
+            # (3.2) Triage, the result will not change much after
+            # several decisive scores in a row or after a mate score of
+            # the previous ply, use less time.
+            if self.triageOpt == 'on' and\
+               (state['decisivePlies'] >= TRIAGE_DECISIVE_PLIES or
+                state['isMateAnnounced']):
+                moveTime = max(1, moveTime / TRIAGE_TIME_DIVISOR)
+                state['triageShortened'] += 1
+            afterMoveTime = moveTime
+            if isScan:
+                moveTime = self.GetScanTime(moveTime)
+            posScore = self.GetAnalysis(scanPrefix + 'after',
+                                        p['nodeAfterMove'],
+                                        p['fenAfterMove'],
+                                        self.GetSearchScoreAfterMove,
+                                        side, moveTime)
+            isPosSearched = True
+        if posScore is ANALYSIS_PENDING:
+            return None
+        a['posScore'] = posScore
+
+        # Count decisive scores in a row for the triage.
+        if posScore is not None and abs(posScore) >= DECISIVE_SCORE:
+            state['decisivePlies'] += 1
+        else:
+            state['decisivePlies'] = 0
+        state['isMateAnnounced'] = posScore is not None and\
+                                   abs(posScore) >= TRIAGE_MATE_SCORE
+
+        # (4) Analyze the position with the engine. Only do this
+        # if posScore is not winning or lossing (more than 3.0 pawns).
+        isAnalyze = (posScore is None or abs(posScore) < DECISIVE_SCORE)\
+                    and self.jobOpt in ANALYZE_JOBS
+
+        # (4.1) Triage, the best move is known when there is only one
+        # legal move or when every move draws by insufficient material.
+        if isAnalyze and self.triageOpt == 'on' and\
+           (p['legalMoveCnt'] == 1 or p['isDrawBeforeMove']):
+            a['engMove'], a['engScore'] = p['sanMove'], posScore
+            a['pvLine'] = (p['fenBeforeMove'], [p['uciMove']])
+            state['triageAvoided'] += 1
+            isAnalyze = False
+
+        if isAnalyze:
+            beforeMoveTime = self.GetAllocatedMoveTime(p['features'])
+            moveTime = beforeMoveTime
+            if isScan:
+                moveTime = self.GetScanTime(moveTime)
+                state['scanned'] += 1
+            result = self.GetAnalysis(scanPrefix + 'before',
+                                      p['nodeBeforeMove'],
+                                      p['fenBeforeMove'],
+                                      self.GetSearchScoreBeforeMove,
+                                      side, p['features'], moveTime)
+            if result is ANALYSIS_PENDING:
+                return None
+            a['engMove'], a['engScore'], a['complexityNumber'],\
+                          a['moveChanges'], pvLine, a['searchStats'] = result
+
+            # The pv may come from the same position in another game.
+            a['pvLine'] = (p['fenBeforeMove'], pvLine[1])
+            isEngSearched = True
+
+        # (4.2) Two-tier screening, a critical ply of the scan is searched
+        # again with -movetime and its marks come from these searches.
+        if isScan and isEngSearched and self.IsCriticalPly(p, a):
+            if isPosSearched:
+                posScore = self.GetAnalysis('after', p['nodeAfterMove'],
+                                            p['fenAfterMove'],
+                                            self.GetSearchScoreAfterMove,
+                                            side, afterMoveTime)
+                if posScore is ANALYSIS_PENDING:
+                    return None
+                a['posScore'] = posScore
+            result = self.GetAnalysis('before', p['nodeBeforeMove'],
+                                      p['fenBeforeMove'],
+                                      self.GetSearchScoreBeforeMove,
+                                      side, p['features'], beforeMoveTime)
+            if result is ANALYSIS_PENDING:
+                return None
+            a['engMove'], a['engScore'], a['complexityNumber'],\
+                          a['moveChanges'], pvLine, a['searchStats'] = result
+            a['pvLine'] = (p['fenBeforeMove'], pvLine[1])
+            state['rescanned'] += 1
+
+        # (5) If game is over by checkmate and stalemate after a move
+        a['isGameOver'] = p['isGameOver']
+
+        # (5.1) Calculate the threat move if game move and engine best
+        # move is the same and the position is complex and the engine
+        # score is not winning or lossing
+        if a['moveChanges'] >= 3 and p['sanMove'] == a['engMove']\
+                and not p['isCheck']\
+                and abs(a['engScore']) <= 2.0:
+            threatMove = self.GetAnalysis('threat', p['nodeBeforeMove'],
+                                          p['fenBeforeMove'],
+                                          self.GetThreatMove)
+            if threatMove is ANALYSIS_PENDING:
+                return None
+            assert threatMove is not None
+            a['threatMove'] = threatMove
+
+        return a
+
+    def GetMoveNag(self, p, a):
+        """ Returns the NAG of the move as written in the notation or None """
+        if a['posScore'] is None or a['engMove'] is None or a['isGameOver']:
+            return None
+        if p['sanMove'] != a['engMove']:
+            return self.GetBadNag(p['side'], a['posScore'], a['engScore'])
+        return self.GetGoodNag(p['side'], a['posScore'], a['engScore'],
+                               a['complexityNumber'], a['moveChanges'])
+
+    def GetPlyRecord(self, plyCnt, p, a):
+        """ Returns the analysis of the ply p in a dict for -records """
+        stats = a['searchStats'] or {'depth': 0, 'nodes': 0, 'time': 0}
+        pv = []
+        if a['pvLine'] is not None:
+            pv = a['pvLine'][1]
+        nag = self.GetMoveNag(p, a)
+        zobrist = chess.polyglot.zobrist_hash(chess.Board(p['fenBeforeMove']))
+        return {'game': self.gameCnt, 'ply': plyCnt, 'fmvn': p['fmvn'],
+                'side': 'w' if p['side'] else 'b',
+                'fen': p['fenBeforeMove'], 'zobrist': '%016x' %(zobrist),
+                'move': p['sanMove'], 'uci': p['uciMove'],
+                'bookMove': a['bookMove'], 'bestMove': a['engMove'],
+                'pv': pv, 'posScore': a['posScore'],
+                'engScore': a['engScore'],
+                'complexityNumber': a['complexityNumber'],
+                'moveChanges': a['moveChanges'],
+                'nag': None if nag is None else int(nag[1:]),
+                'threatMove': a['threatMove'], 'depth': stats['depth'],
+                'nodes': stats['nodes'], 'searchTime': stats['time']}
+
+    def WriteRecords(self, records):
+        """ Appends the records of a game to the -records file. It is a
+            json object per line, or with .bin extension fixed size
+            RECORD_FORMAT records that can be loaded with numpy.
+        """
+        if not self.recordsOpt.endswith('.bin'):
+            with open(self.recordsOpt, 'a') as f:
+                for r in records:
+                    f.write(json.dumps(r, sort_keys=True) + '\n')
+            return
+
+        def ToCp(score):
+            if score is None:
+                return RECORD_NO_SCORE
+            return int(round(100 * score))
+
+        with open(self.recordsOpt, 'ab') as f:
+            for r in records:
+                bestMove = r['pv'][0] if r['pv'] else ''
+                f.write(struct.pack(RECORD_FORMAT, int(r['zobrist'], 16),
+                                    r['game'], r['ply'], r['side'] == 'w',
+                                    str(r['uci']), str(bestMove),
+                                    ToCp(r['posScore']), ToCp(r['engScore']),
+                                    r['complexityNumber'], r['moveChanges'],
+                                    r['nag'] or 0, r['depth'], r['nodes'],
+                                    r['searchTime']))
+
+    def WriteGameHeader(self, game):
+        """ Write the tags and the analysis comment of the game """
         # Get engine id name for the Annotator tag.
         engineIdName = self.engIdName
 
-        # Disable bookOpt if engine is not Brainfish.
+        # Save the tag section of the game.
+        for key, value in game.headers.items():
+            with open(self.outfn, 'a+') as f:
+                f.write('[%s \"%s\"]\n' %(key, value))
+
+        # Write the annotator tag.
+        with open(self.outfn, 'a+') as f:
+            f.write('[Annotator "%s"]\n\n' %(engineIdName))
+
+        # Before the movetext are written, add a comment of whether
+        # move comments are from static evaluation or search score of the engine.
+        if self.evalOpt == 'static':
+            with open(self.outfn, 'a+') as f:
+                f.write('{Move comments are from engine static evaluation.}\n')
+        elif self.evalOpt == 'search':
+            with open(self.outfn, 'a+') as f:
+                hashValue = self.GetEngineOptionValue('Hash')
+                if hashValue is None:
+                    hashValue = str(DEFAULT_HASH)
+                threadsValue = self.GetEngineOptionValue('Threads')
+                if threadsValue is None:
+                    threadsValue = str(DEFAULT_THREADS)
+                
+                # Don't write Hash in the comment if the analyzing engine
+                # has no Hash option like Lc0 or Leela Chess Zero
+                if not self.IsEngineOption('Hash'):
+                    f.write('{Threads %s, @ %0.1fs/pos}\n'\
+                        %(threadsValue, self.moveTimeOpt/1000.0))
+                else:
+                    f.write('{Hash %smb, Threads %s, @ %0.1fs/pos}\n'\
+                        %(hashValue, threadsValue,
+                          self.moveTimeOpt/1000.0))
+
+    def AnnotateGame(self, game):
+        """ Analyze the moves of the game and write it to the output file """
+        if self.jobOpt == 'extract':
+            self.ExtractGamePositions(game)
+            return
+        for record in self.AnnotateGamePlies(game):
+            pass
+
+    def ExtractGamePositions(self, game):
+        """ Analyzes the moves of the game like AnnotateGame and appends
+            the positions of its ?? and ? moves to the output epd file.
+            Only the lines of one game are kept in memory.
+        """
+        outfn = self.outfn
+        self.outfn = None
+        lines = []
+        try:
+            for record in self.AnnotateGamePlies(game):
+                if record['nag'] in EXTRACT_NAGS:
+                    lines.append(self.GetExtractEpdLine(game, record))
+        finally:
+            self.outfn = outfn
+        if lines:
+            with open(self.outfn, 'a') as f:
+                f.write(''.join(lines))
+
+    def GetExtractEpdLine(self, game, record):
+        """ Returns the epd line of -job extract for the ply record of
+            game, with bm, am, ce, pv, id and Ae opcodes. The ce is from
+            the side to move.
+        """
+        fen = record['fen']
+        epd = ' '.join(fen.split()[0:4])
+        ce = int(round(100 * record['engScore']))
+        if record['side'] == 'b':
+            ce = -ce
+
+        # The pv is in san moves without move numbers.
+        board = chess.Board(fen)
+        pv = []
+        for m in record['pv']:
+            try:
+                move = chess.Move.from_uci(m)
+                pv.append(board.san(move))
+            except ValueError:
+                break
+            board.push(move)
+
+        # The source game and the ply, the tags are without quotes.
+        tags = [game.headers.get(k, '?').replace('"', '') for k in
+                ['White', 'Black', 'Event', 'Site', 'Date', 'Round']]
+        gameId = '%s - %s, %s, %s, %s, round %s, ply %d'\
+                 %(tuple(tags) + (record['ply'],))
+        return '%s bm %s; am %s; ce %+d; pv %s; id \"%s\"; Ae \"%s\";\n'\
+               %(epd, record['bestMove'], record['move'], ce,
+                 ' '.join(pv) or record['bestMove'], gameId, self.engIdName)
+
+    def AnnotateGamePlies(self, game):
+        """ Analyzes the moves of the game and yields the record of each
+            ply as soon as it is analyzed, see GetPlyRecord. The game is
+            also written to the output file when outfn is not None.
+        """
+        isWrite = self.outfn is not None
+
+        # Initialize move error calculation
+        moveError = {'white':0.0, 'black':0.0}
+        moveCnt = {'white':0, 'black':0}
+
+        # Used for formatting the output.
+        self.writeCnt = 0
+
+        # Keeps isCereEnd, we don't access cere book if it is true,
+        # and the triage counts.
+        state = self.GetGameState()
+
+        # Analyze the game in one engine session with a warm hash.
+        if self.sessionOpt == 'game':
+            self.StartGameSession(game)
+
+        # Analyze the positions from the end of the game, the moves
+        # are then written from the results in the analysis cache.
+        isBackward = self.directionOpt == 'backward' and\
+                     self.analysisCache is None
+        if isBackward:
+            self.AnalyzeGameBackward(game)
+
+        if isWrite:
+            self.WriteGameHeader(game)
+
+        # Save result to be written later as game termination marker.
+        res = game.headers['Result']
+
+        # The analysis of each ply for -records.
+        self.gameCnt += 1
+        records = []
+
+        # Loop thru the moves within this game.
+        try:
+            if self.pipelineOpt == 'on':
+                for record in self.PipelineGamePlies(game, state, records,
+                                                     moveError, moveCnt):
+                    yield record
+            else:
+                for plyCnt, p in enumerate(self.GetGamePlies(game), 1):
+                    a = self.AnalyzePly(p, state)
+                    yield self.FinishPly(plyCnt, p, a, records, moveError,
+                                         moveCnt)
+
+            if isWrite:
+                self.WriteGameEnd(moveError, moveCnt, res)
+            if self.triageOpt == 'on' and not self.isQuiet:
+                print('Triage: %d engine searches avoided, %d shortened'\
+                      %(state['triageAvoided'], state['triageShortened']))
+            if self.scanTimeOpt > 0 and not self.isQuiet:
+                print('Screening: %d plies scanned, %d searched again'\
+                      %(state['scanned'], state['rescanned']))
+            if records:
+                self.WriteRecords(records)
+        finally:
+            self.EndGameSession()
+            if isBackward:
+                self.analysisCache = None
+
+    def FinishPly(self, plyCnt, p, a, records, moveError, moveCnt):
+        """ Returns the record of the analyzed ply p, it is also kept in
+            records for -records, and writes the ply.
+        """
+        record = self.GetPlyRecord(plyCnt, p, a)
+        if self.recordsOpt != 'none':
+            records.append(record)
+        self.WriteGamePly(p, a, moveError, moveCnt)
+        return record
+
+    def PipelineGamePlies(self, game, state, records, moveError, moveCnt):
+        """ Yields the records of the plies of game like the loop of
+            AnnotateGamePlies, with -pipeline on. A thread prepares the
+            plies and probes the cerebellum book ahead, the engine
+            searches are run here and a thread writes the plies. The
+            stages are joined by bounded queues that keep the order of
+            the plies, so the output is the same as without -pipeline.
+        """
+        plyQueue = Queue.Queue(PIPELINE_QUEUE_SIZE)
+        writeQueue = Queue.Queue(PIPELINE_QUEUE_SIZE)
+        recordQueue = Queue.Queue()
+        isStopped = threading.Event()
+        errors = []
+
+        def Prepare():
+            # The book is probed until the ply that would set isCereEnd.
+            # A result that may come from a cache is left to AnalyzePly.
+            isBookEnd = self.bookOpt != 'cerebellum' or\
+                        self.analysisCache is not None
+            try:
+                for p in self.GetGamePlies(game):
+                    if isStopped.is_set():
+                        return
+                    if not isBookEnd and p['nodeBeforeMove'] is None:
+                        p['bookMove'] = self.GetCerebellumBookMove(
+                            p['fenBeforeMove'])
+                        if p['bookMove'] is None and\
+                           p['fmvn'] > BOOK_MOVE_LIMIT:
+                            isBookEnd = True
+                    plyQueue.put(p)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                plyQueue.put(None)
+
+        def Write():
+            # After an error the plies are only taken from the queue.
+            for item in iter(writeQueue.get, None):
+                if errors:
+                    continue
+                try:
+                    recordQueue.put(self.FinishPly(*(item + (records,
+                                                     moveError, moveCnt))))
+                except Exception as e:
+                    errors.append(e)
+
+        prepareThread = threading.Thread(target=Prepare)
+        writeThread = threading.Thread(target=Write)
+        prepareThread.daemon = True
+        writeThread.daemon = True
+        prepareThread.start()
+        writeThread.start()
+        try:
+            for plyCnt, p in enumerate(iter(plyQueue.get, None), 1):
+                writeQueue.put((plyCnt, p, self.AnalyzePly(p, state)))
+                while not recordQueue.empty():
+                    yield recordQueue.get()
+            writeQueue.put(None)
+            writeThread.join()
+            if errors:
+                raise errors[0]
+            while not recordQueue.empty():
+                yield recordQueue.get()
+        finally:
+            # Stop the threads when the plies are not all analyzed.
+            isStopped.set()
+            if writeThread.is_alive():
+                writeQueue.put(None)
+                writeThread.join()
+            while prepareThread.is_alive():
+                try:
+                    plyQueue.get(timeout=QUEUE_POLL_TIME)
+                except Queue.Empty:
+                    pass
+
+    def WriteGamePly(self, p, a, moveError, moveCnt):
+        """ Adds the error of the move to moveError and moveCnt and writes
+            the move and its comments when there is an output file.
+        """
+        side, fmvn, sanMove = p['side'], p['fmvn'], p['sanMove']
+
+        # Calculate total move errors incrementally and get the average later
+        if a['engMove'] is not None and fmvn >= 12 and\
+           self.evalOpt == 'search' and sanMove != a['engMove']:
+            if side:
+                scoreError = a['engScore'] - a['posScore']
+                moveError['white'] += scoreError
+                moveCnt['white'] += 1
+            else:
+                scoreError = -1 * (a['engScore'] - a['posScore'])
+                moveError['black'] += scoreError
+                moveCnt['black'] += 1
+
+        # Write moves and comments.
+        if self.outfn is not None:
+            self.WriteNotation(side, fmvn, sanMove, a['bookMove'],
+                               a['posScore'], a['isGameOver'],
+                               a['engMove'], a['engScore'],
+                               a['complexityNumber'], a['moveChanges'],
+                               a['pvLine'], a['threatMove'])
+
+    def WriteGameEnd(self, moveError, moveCnt, res):
+        """ Writes the average errors, the rating difference and the game
+            termination marker to the output file.
+        """
+        # All moves are parsed in this game, calculate average
+        # errors and rating difference.
+        averageError = {'white':0.0, 'black':0.0}
+        ratingDiff = {'white':0, 'black':0}                
+        if moveCnt['white']:
+            averageError['white'] = moveError['white']/moveCnt['white']                
+            ratingDiff['white'] = self.GetRatingDiff(averageError['white'])
+        if moveCnt['black']:
+            averageError['black'] = moveError['black']/moveCnt['black']            
+            ratingDiff['black'] = self.GetRatingDiff(averageError['black'])
+        
+        # Write errors, rating difference and game termination
+        # marker to output file.
+        ratingDifference = abs(ratingDiff['white'] - ratingDiff['black'])
+        self.WriteTerminationMarker(moveCnt['white'],
+                                    moveCnt['black'],
+                                    averageError['white'],
+                                    averageError['black'],
+                                    ratingDifference, res)               
+
+    def AnalyzeGameBackward(self, game):
+        """ Analyzes the positions of the game from the last move to the
+            first and saves the results in the analysis cache. Like in
+            AnalyzeUniquePositions, the queries that depend on earlier
+            results are analyzed in the next round.
+        """
+        self.analysisCache = {}
+        plies = self.GetGamePlies(game)
+        while True:
+            self.isPlanning = True
+            self.pendingAnalysis = {}
+            state = self.GetGameState()
+            for p in plies:
+                self.AnalyzePly(p, state)
+            self.isPlanning = False
+            if not self.pendingAnalysis:
+                break
+
+            # The queries were collected from the first move.
+            keys = sorted(self.pendingAnalysis,
+                          key=lambda k: self.pendingAnalysis[k][3],
+                          reverse=True)
+            for key in keys:
+                func, pos, args, _ = self.pendingAnalysis[key]
+                self.analysisCache[key] = func(pos, *args)
+        self.pendingAnalysis = {}
+
+    def AnalyzeUniquePositions(self):
+        """ Phase 1 and 2 of -dedup on. The games are read without
+            writing to collect the positions that AnnotatePgn will query,
+            then each unique position is analyzed once and saved in the
+            analysis cache. Queries that depend on earlier results, like
+            the threat move after the search before the move, are
+            collected in the next round until nothing is pending.
+        """
+        self.analysisCache = {}
+        self.analysisQueries = {}
+        roundCnt = 0
+        while True:
+            # Phase 1, collect the queries that are not yet analyzed.
+            self.isPlanning = True
+            self.pendingAnalysis = {}
+            for game in self.ReadGames():
+                state = self.GetGameState()
+                for p in self.GetGamePlies(game):
+                    self.AnalyzePly(p, state)
+            self.isPlanning = False
+            if not self.pendingAnalysis:
+                break
+
+            # Phase 2, analyze each unique position once.
+            roundCnt += 1
+            posCnt = len(self.pendingAnalysis)
+            print('Dedup round %d: %d unique positions to analyze'\
+                  %(roundCnt, posCnt))
+            for i, key in enumerate(self.pendingAnalysis):
+                func, pos, args, _ = self.pendingAnalysis[key]
+                self.analysisCache[key] = func(pos, *args)
+                if (i+1) % 100 == 0:
+                    print('Analyzed %d/%d' %(i+1, posCnt))
+        self.pendingAnalysis = {}
+
+    def PrintDedupReport(self):
+        """ Prints the position queries per unique analyzed position """
+        print('\n:: DEDUP REPORT ::')
+        totalQueries, totalUnique = 0, 0
+        for kind in ['book', 'static', 'after', 'before', 'threat',
+                     'scanafter', 'scanbefore']:
+            queries = self.analysisQueries.get(kind, 0)
+            unique = len([k for k in self.analysisCache if k[0] == kind])
+            if not queries:
+                continue
+            totalQueries += queries
+            totalUnique += unique
+            print('%-6s: queries %d, unique %d, ratio %0.2f'\
+                  %(kind, queries, unique, float(queries)/max(1, unique)))
+        print('total : queries %d, unique %d, ratio %0.2f\n'\
+              %(totalQueries, totalUnique,
+                float(totalQueries)/max(1, totalUnique)))
+
+    def SearchPonderPosition(self, game):
+        """ Saves the result of the infinite search in the analysis
+            cache when a new move of game was played from the pondered
+            position. AnnotateGame searches the position after the move
+            first and that would stop the infinite search.
+        """
+        if self.ponderThread is None or self.jobOpt != 'analyze':
+            return
+        for p in self.GetGamePlies(game):
+            if p['fenBeforeMove'] == self.ponderPos and not p['isTheory']:
+                moveTime = self.GetAllocatedMoveTime(p['features'])
+                self.GetAnalysis('before', p['nodeBeforeMove'],
+                                 p['fenBeforeMove'],
+                                 self.GetSearchScoreBeforeMove,
+                                 p['side'], p['features'], moveTime)
+                break
+
+    def WatchPgn(self):
+        """ Annotates the games of a pgn file that is updated by a live
+            broadcast. The file is read every -poll millisec, a game with
+            new moves is annotated again from the analysis cache, so only
+            its new plies are analyzed, and the output file is written
+            again. Between updates the engine searches the position of
+            the last updated game. With -latency the movetime of the new
+            plies of an update is cut to fit in the budget. It runs until
+            Ctrl+C is pressed.
+        """
+        if self.theoryOpt:
+            print('\nWarning!! -theory is not used with -watch on.\n')
+            self.theoryOpt = 0
+        self.analysisCache = {}
+        outfn = self.outfn
+        moveTime = self.moveTimeOpt
+        tmpFile = outfn + '.tmp'
+
+        # The fingerprint, annotation and plies of each game by its tags.
+        fingerprints, annotations, order, plyCnts = {}, {}, [], {}
+
+        print('Watching %s, press Ctrl+C to stop.' %(self.infn))
+        try:
+            while True:
+                isUpdated, ponderGame = False, None
+                tagCnt = {}
+                for fingerprint, text in self.ReadGameTexts():
+                    game = chess.pgn.read_game(StringIO(text))
+                    if game is None:
+                        continue
+
+                    # Games with the same tags are told apart by their order.
+                    key = tuple([game.headers.get(k, '?') for k in
+                                 ['Event', 'Site', 'Round', 'White', 'Black']])
+                    tagCnt[key] = tagCnt.get(key, 0) + 1
+                    key += (tagCnt[key],)
+                    if fingerprints.get(key) == fingerprint:
+                        continue
+                    if key not in fingerprints:
+                        order.append(key)
+                    fingerprints[key] = fingerprint
+
+                    # Annotate the game again, only new plies are searched.
+                    startTime = time.time()
+                    plyCnt = len(game.end().board().move_stack)
+                    if self.latencyOpt > 0:
+                        newPlyCnt = max(1, plyCnt - plyCnts.get(key, 0))
+                        self.moveTimeOpt = min(moveTime, max(1,
+                            self.latencyOpt / (LATENCY_SEARCHES_PER_PLY *
+                                               newPlyCnt)))
+                    plyCnts[key] = plyCnt
+                    self.SearchPonderPosition(game)
+                    DeleteFile(tmpFile)
+                    self.outfn = tmpFile
+                    self.AnnotateGame(game)
+                    self.outfn = outfn
+                    self.moveTimeOpt = moveTime
+                    with open(tmpFile, 'r') as f:
+                        annotations[key] = f.read()
+                    elapsed = time.time() - startTime
+                    print('Game %d: %d plies, annotated in %0.1fs'\
+                          %(order.index(key) + 1, plyCnt, elapsed))
+                    if self.latencyOpt > 0 and\
+                       elapsed * 1000 > self.latencyOpt:
+                        print('Warning! game %d update took %d ms, more than -latency %d ms.'\
+                              %(order.index(key) + 1, int(elapsed * 1000),
+                                self.latencyOpt))
+                    isUpdated = True
+                    if game.headers.get('Result', '*') == '*':
+                        ponderGame = game
+
+                # Write all games again when one is updated.
+                if isUpdated:
+                    with open(tmpFile, 'w') as f:
+                        for key in order:
+                            f.write(annotations[key])
+                    DeleteFile(outfn)
+                    os.rename(tmpFile, outfn)
+
+                # Search the next move of the last updated game.
+                if ponderGame:
+                    board = ponderGame.end().board()
+                    self.StartGameSession(ponderGame)
+                    self.StartPonder(board.fen())
+                    self.EndGameSession()
+                time.sleep(self.pollOpt / 1000.0)
+        except KeyboardInterrupt:
+            print('Watch stopped.')
+        self.outfn = outfn
+        self.moveTimeOpt = moveTime
+        self.QuitSessionEngine()
+        DeleteFile(tmpFile)
+
+    def CheckEngineCapabilities(self):
+        """ Disables the book and eval options that the engine can not do """
+        # Disable bookOpt if engine can not use the cerebellum book.
         if self.bookOpt == 'cerebellum':
-            if 'Brainfish' not in engineIdName:
+            if not self.IsEngineOption('BookPath'):
                 self.bookOpt = 'none'
-                print('\nWarning!! engine is not Brainfish, cerebellum book is disabled.\n')
-        
-        # Open the input pgn file
-        pgnHandle = open(self.infn, 'r')
+                print('\nWarning!! engine has no BookPath option, cerebellum book is disabled.\n')
 
-        # Read the input pgn file using the python-chess module.
-        game = chess.pgn.read_game(pgnHandle)
+        # The multipv complexity needs the MultiPV option of the engine.
+        if self.complexityOpt == 'multipv' and\
+           not self.IsEngineOption('MultiPV'):
+            self.complexityOpt = 'movechanges'
+            print('\nWarning!! engine has no MultiPV option, -complexity movechanges is used.\n')
 
-        # Used for displaying progress in console.
-        gameCnt = 0
+        # Disable evalOpt if engine has no eval command.
+        if self.evalOpt == 'static' and not self.engineProbe['eval']:
+            self.evalOpt = 'none'
+            print('\nWarning!! engine has no eval command, -eval static is disabled.\n')
 
-        # Loop thru the games.
-        while game:
-            gameCnt += 1
+    def AnnotatePgn(self):
+        """ Parse the pgn file and annotate the games """
+        self.CheckEngineCapabilities()
 
-            # Initialize move error calculation
-            moveError = {'white':0.0, 'black':0.0}
-            moveCnt = {'white':0, 'black':0}
+        # Live games are annotated as their moves come in.
+        if self.watchOpt == 'on':
+            self.WatchPgn()
+            return
 
-            # Used for formatting the output.
-            self.writeCnt = 0
+        # Theory depends on all games, a new game can change the old ones.
+        if self.incrementalOpt == 'on' and self.theoryOpt:
+            print('\nWarning!! -incremental is not used with -theory.\n')
+            self.incrementalOpt = 'off'
 
-            # Show progress in console.
-            print('Annotating game %d...' %(gameCnt))
+        # The unchanged games of the previous run are not read again.
+        if self.incrementalOpt == 'on':
+            self.unchangedGames = self.ReadManifest()
 
-            # We don't access cere book if isCereEnd is true.
-            isCereEnd = False
+        # Build the opening tree, games that share the moves from the
+        # start will share the book moves and analysis of those positions.
+        if self.openingTreeOpt == 'on' or self.theoryOpt:
+            self.openingTree = self.BuildOpeningTree()
+            nodeCnt, theoryCnt = self.GetOpeningTreeInfo(self.openingTree)
+            print('Opening tree: %d positions, %d theory positions\n'\
+                  %(nodeCnt, theoryCnt))
 
-            # Save the tag section of the game.
-            for key, value in game.headers.items():
-                with open(self.outfn, 'a+') as f:
-                    f.write('[%s \"%s\"]\n' %(key, value))
+        # Analyze each unique position first, phase 3 below will
+        # write the games from the analysis cache.
+        if self.dedupOpt == 'on':
+            self.AnalyzeUniquePositions()
 
-            # Write the annotator tag.
-            with open(self.outfn, 'a+') as f:
-                f.write('[Annotator "%s"]\n\n' %(engineIdName))
+        # Used for displaying progress in console.
+        gameCnt = 0
 
-            # Before the movetext are written, add a comment of whether
-            # move comments are from static evaluation or search score of the engine.
-            if self.evalOpt == 'static':
-                with open(self.outfn, 'a+') as f:
-                    f.write('{Move comments are from engine static evaluation.}\n')
-            elif self.evalOpt == 'search':
-                with open(self.outfn, 'a+') as f:
-                    hashValue = self.GetEngineOptionValue('Hash')
-                    if hashValue is None:
-                        hashValue = str(DEFAULT_HASH)
-                    threadsValue = self.GetEngineOptionValue('Threads')
-                    if threadsValue is None:
-                        threadsValue = str(DEFAULT_THREADS)
-                    
-                    # Don't write Hash in the comment if the analyzing engine
-                    # is Lc0 or Leela Chess Zero
-                    if 'lc0' in engineIdName.lower() or\
-                        'leela chess zero' in engineIdName.lower():
-                        f.write('{Threads %s, @ %0.1fs/pos}\n'\
-                            %(threadsValue, self.moveTimeOpt/1000.0))
-                    else:
-                        f.write('{Hash %smb, Threads %s, @ %0.1fs/pos}\n'\
-                            %(hashValue, threadsValue,
-                              self.moveTimeOpt/1000.0))
-
-            # Save result to be written later as game termination marker.
-            res = game.headers['Result']
-
-            # Loop thru the moves within this game.
-            gameNode = game        
-            while gameNode.variations:
-                side = gameNode.board().turn
-                fmvn = gameNode.board().fullmove_number             
-                nextNode = gameNode.variation(0)                      
-                sanMove = nextNode.san()
-                complexityNumber, moveChanges = 0, 0
-                threatMove = None
-
-                # (0) Don't start the engine analysis when fmvn is
-                # below moveStart and not using a cerebellum book.
-                if fmvn < self.moveStartOpt and self.bookOpt != 'cerebellum':
-                    cereBookMove = None
-                    self.WriteNotation(side, fmvn, sanMove, cereBookMove,
-                                       None, False, None, None, 0, 0,
-                                       None, threatMove)
-                    gameNode = nextNode
-                    continue                    
-
-                # (1) Try to get a cerebellum book move.
-                cereBookMove = None
-                if self.bookOpt == 'cerebellum' and not isCereEnd:
-                    # Use FEN before a move.
-                    fenBeforeMove = gameNode.board().fen()
-                    cereBookMove = self.GetCerebellumBookMove(fenBeforeMove)
-
-                    # End trying to find cerebellum book move beyond BOOK_MOVE_LIMIT.
-                    if cereBookMove is None and fmvn > BOOK_MOVE_LIMIT:
-                        isCereEnd = True
-
-                # (2) Don't start the engine analysis when fmvn is below moveStart.
-                if fmvn < self.moveStartOpt and cereBookMove is not None:
-                    self.WriteNotation(side, fmvn, sanMove, cereBookMove,
-                                       None, False, None, None, 0, 0,
-                                       None, threatMove)
-                    gameNode = nextNode
-                    continue 
-
-                # (3) Get the posScore or the score of the player move.
-                # Can be by static eval of the engine or search score of the engine
-                posScore = None
-                if self.evalOpt == 'static':
-                    fenAfterMove = nextNode.board().fen()
-                    staticScore = self.GetStaticEvalAfterMove(fenAfterMove)
-                    posScore = staticScore
-                elif self.evalOpt == 'search':
-                    fenAfterMove = nextNode.board().fen()
-                    searchScore = self.GetSearchScoreAfterMove(fenAfterMove,
-                                                               side)
-                    posScore = searchScore
-
-                # (4) Analyze the position with the engine. Only do this
-                # if posScore is not winning or lossing (more than 3.0 pawns).
-                engBestMove, engBestScore, pvLine = None, None, None
-                if (posScore is None or abs(posScore) < DECISIVE_SCORE)\
-                   and self.jobOpt == 'analyze':
-                    engBestMove, engBestScore, complexityNumber,\
-                                 moveChanges, pvLine =\
-                        self.GetSearchScoreBeforeMove(gameNode.board().fen(),
-                                                      side)
-
-                    # Calculate total move errors incrementally and get the average later
-                    if fmvn >= 12 and self.evalOpt == 'search' and\
-                       sanMove != engBestMove:
-                        if side:
-                            scoreError = engBestScore - posScore
-                            moveError['white'] += scoreError
-                            moveCnt['white'] += 1
-                        else:
-                            scoreError = -1 * (engBestScore - posScore)
-                            moveError['black'] += scoreError
-                            moveCnt['black'] += 1
-                    
-                # (5) If game is over by checkmate and stalemate after a move              
-                isGameOver = nextNode.board().is_checkmate() or\
-                             nextNode.board().is_stalemate()
-
-                # (5.1) Calculate the threat move if game move and engine best
-                # move is the same and the position is complex and the engine
-                # score is not winning or lossing
-                if moveChanges >= 3 and sanMove == engBestMove\
-                        and not gameNode.board().is_check()\
-                        and abs(engBestScore) <= 2.0:
-                    threatMove = self.GetThreatMove(gameNode.board().fen())
-                    assert threatMove is not None
-                
-                # (6) Write moves and comments.
-                self.WriteNotation(side, fmvn, sanMove, cereBookMove,
-                                   posScore, isGameOver,
-                                   engBestMove, engBestScore,
-                                   complexityNumber, moveChanges,
-                                   pvLine, threatMove)
-
-                # Read the next position.
-                gameNode = nextNode
-
-            # All moves are parsed in this game, calculate average
-            # errors and rating difference.
-            averageError = {'white':0.0, 'black':0.0}
-            ratingDiff = {'white':0, 'black':0}                
-            if moveCnt['white']:
-                averageError['white'] = moveError['white']/moveCnt['white']                
-                ratingDiff['white'] = self.GetRatingDiff(averageError['white'])
-            if moveCnt['black']:
-                averageError['black'] = moveError['black']/moveCnt['black']            
-                ratingDiff['black'] = self.GetRatingDiff(averageError['black'])
-            
-            # Write errors, rating difference and game termination
-            # marker to output file.
-            ratingDifference = abs(ratingDiff['white'] - ratingDiff['black'])
-            self.WriteTerminationMarker(moveCnt['white'],
-                                        moveCnt['black'],
-                                        averageError['white'],
-                                        averageError['black'],
-                                        ratingDifference, res)               
+        # Loop thru the games.
+        if self.incrementalOpt == 'on':
+            self.AnnotateChangedGames()
+        else:
+            DeleteFile(self.outfn + '.manifest')
+            for game in self.ReadGames():
+                gameCnt += 1
 
-            # Read the next game.
-            game = chess.pgn.read_game(pgnHandle)
+                # Show progress in console.
+                print('Annotating game %d...' %(gameCnt))
+                self.AnnotateGame(game)
+        self.QuitSessionEngine()
 
-        # Close the file handle.
-        pgnHandle.close()
+        if self.dedupOpt == 'on':
+            self.PrintDedupReport()
+        if self.openingTree is not None:
+            print('Opening tree: %d engine queries shared' %(self.treeHits))
+        if self.sharedCache is not None:
+            print(self.sharedCache.GetReport())
 
     def AnnotateEpd(self):
         """ Annotate epd file with bm, ce, acs, acd, and Ae opcodes
             Ae - analyzing engine, a special opcode for this script.
         """
+        if self.evalOpt == 'static' and not self.engineProbe['eval']:
+            print('Error! engine has no eval command, use -eval search.')
+            return
+        for record in self.AnnotateEpdLines(ReadFileLines(self.infn)):
+            pass
+
+    def AnnotateEpdLines(self, epdLines):
+        """ Analyzes the epd or fen lines and yields a dict with the epd,
+            fen, acd, acs, bm and ce of each position as soon as it is
+            analyzed. The line is also written to the output file with
+            the opcodes when outfn is not None.
+        """
         cntEpd = 0
-        
-        # Open the epd file for reading.
-        with open(self.infn, 'r') as f:
-            for lines in f:
-                cntEpd += 1
-                
-                # Remove white space at beginning and end of lines.
-                epdLine = lines.strip()
+        cntAvoided, cntShortened = 0, 0
+        acd, acs, bm = None, None, None
 
-                # Get only first 4 fields [pieces side castle_flag ep_sq].
-                epdLineSplit = epdLine.split()
-                epd = ' '.join(epdLineSplit[0:4])
-                hmvc = self.GetHmvcInEpd(epdLine)
+        # Read the lines of the epd file.
+        for lines in epdLines:
+            cntEpd += 1
+            
+            # Remove white space at beginning and end of lines.
+            epdLine = lines.strip()
 
-                # Add hmvc and fmvn to create a FEN for the engine.
-                fen = epd + ' ' + hmvc + ' 1'
+            # Get only first 4 fields [pieces side castle_flag ep_sq].
+            epdLineSplit = epdLine.split()
+            epd = ' '.join(epdLineSplit[0:4])
+            hmvc = self.GetHmvcInEpd(epdLine)
 
-                # Show progress in console.
+            # Add hmvc and fmvn to create a FEN for the engine.
+            fen = epd + ' ' + hmvc + ' 1'
+
+            # Show progress in console.
+            if not self.isQuiet:
                 print('epd %d: %s' %(cntEpd, epd))
 
-                # If this position has no legal move then we skip it.
-                pos = chess.Board(fen)
-                isGameOver = pos.is_checkmate() or pos.is_stalemate()
-                if isGameOver:
-                    # Show warning in console.
+            # If this position has no legal move then we skip it.
+            pos = chess.Board(fen)
+            isGameOver = pos.is_checkmate() or pos.is_stalemate()
+            if isGameOver:
+                # Show warning in console.
+                if not self.isQuiet:
                     print('Warning! epd \"%s\"' %(epd))
                     print('has no legal move - skipped.\n')
-                    continue
+                continue
 
-                # Get engine analysis.
-                if self.evalOpt == 'static':
-                    ce = self.GetEpdEngineStaticScore(fen)
-                elif self.evalOpt != 'none':
-                    acd, acs, bm, ce = self.GetEpdEngineSearchScore(fen)
+            # Get engine analysis.
+            if self.evalOpt == 'static':
+                ce = self.GetEpdEngineStaticScore(fen)
+            elif self.evalOpt != 'none' and self.triageOpt == 'on'\
+                 and pos.is_insufficient_material():
+                # Triage, a dead draw needs no search, there is no bm.
+                acd, acs, bm, ce = None, None, None, 0
+                cntAvoided += 1
+            elif self.evalOpt != 'none' and self.triageOpt == 'on'\
+                 and (pos.legal_moves.count() == 1 or
+                      pos.can_claim_fifty_moves()):
+                # Triage, only the score is needed with one legal move,
+                # and a fifty move claim may not be made by the player.
+                moveTime = max(1, self.moveTimeOpt / TRIAGE_TIME_DIVISOR)
+                acd, acs, bm, ce = self.GetEpdEngineSearchScore(fen,
+                                                                moveTime)
+                cntShortened += 1
+            elif self.evalOpt != 'none':
+                acd, acs, bm, ce = self.GetEpdEngineSearchScore(fen)
 
-                # Show progress in console.
-                if self.evalOpt == 'search':
+            # Show progress in console.
+            if not self.isQuiet:
+                if self.evalOpt == 'search' and bm is not None:
                     print('bm: %s' %(bm))
                 print('ce: %+d\n' %(ce))
 
-                # Save to output file the epd analysis.
+            # Save to output file the epd analysis.
+            if self.outfn is not None:
                 with open(self.outfn, 'a') as f1:
                     if self.evalOpt == 'static':
                         f1.write('%s ce %+d; c0 \"%s\"; Ae \"%s\";\n'\
                                  %(epd, ce,
                                    'ce is static eval of engine',
                                    self.engIdName))
+                    elif self.evalOpt != 'none' and bm is None:
+                        f1.write('%s ce %+d; c0 \"%s\"; Ae \"%s\";\n'\
+                                 %(epd, ce,
+                                   'draw by insufficient material',
+                                   self.engIdName))
                     elif self.evalOpt != 'none':
                         f1.write('%s acd %d; acs %d; bm %s; ce %+d; Ae \"%s\";\n'\
                                  %(epd, acd, acs, bm, ce, self.engIdName))
+            yield {'epd': epd, 'fen': fen, 'acd': acd, 'acs': acs,
+                   'bm': bm, 'ce': ce}
+
+        if self.triageOpt == 'on' and not self.isQuiet:
+            print('Triage: %d engine searches avoided, %d shortened'\
+                  %(cntAvoided, cntShortened))
 
-    def GetEpdBm(self, epdLineList):
+    def GetEpdBm(self, epdLineList, opcode='bm'):
         """ return the bm in a list format in the epd line.
-            There can be more 1 bm in a given epd.
+            There can be more 1 bm in a given epd. Other move
+            opcodes like am are read when given in opcode.
         """
         # Example epd line.
         # [pieces] [side] [castle] [ep] bm e4 Nf3; c0 "id 1";
-        bmIndex = epdLineList.index('bm')
+        bmIndex = epdLineList.index(opcode)
 
         # Extract the string beyond the bm.
         bmStartValue = ' '.join(epdLineList[bmIndex+1:])
@@ -1632,6 +3391,12 @@ class Analyze():
                 break
         return found
 
+    def GetIdInEpd(self, epdLine):
+        """ Returns the value of the id opcode in an epd line or None """
+        if 'id "' not in epdLine:
+            return None
+        return epdLine.split('id "')[1].split('"')[0]
+
     def GetHmvcInEpd(self, epdLine):
         """ Returns hmvc in an epd line """        
         if 'hmvc' not in epdLine:
@@ -1651,61 +3416,66 @@ class Analyze():
         cntEpd = 0
         cntCorrect = 0
         cntValidEpd = 0
+        cntAvoided = 0
         
-        # Open the epd file for reading.
-        with open(self.infn, 'r') as f:
-            for lines in f:
-                cntEpd += 1
-                
-                # Remove white space at beginning and end of lines.
-                epdLine = lines.strip()
-
-                # Get the first 4 fields [pieces side castle_flag ep_sq],
-                # also search the hmvc opcode.
-                epdLineSplit = epdLine.split()
-                epd = ' '.join(epdLineSplit[0:4])
-                hmvc = self.GetHmvcInEpd(epdLine)
-
-                # Add hmvc and fmvn to create a FEN for the engine.
-                fen = epd + ' ' + hmvc + ' 1'
-
-                # Show progress in console.
-                print('EPD %d: %s' %(cntEpd, epdLine))
-                print('FEN %d: %s' %(cntEpd, fen))
-
-                # If this position has no legal move then we skip it.
-                pos = chess.Board(fen)
-                isGameOver = pos.is_checkmate() or pos.is_stalemate()
-                if isGameOver:
-                    # Show warning in console.
-                    print('Warning! epd \"%s\"' %(epd))
-                    print('has no legal move - skipped.\n')
-                    continue
+        # Read the lines of the epd file.
+        for lines in ReadFileLines(self.infn):
+            cntEpd += 1
+            
+            # Remove white space at beginning and end of lines.
+            epdLine = lines.strip()
 
-                # If the epd line has no bm then we just skip it.
-                if 'bm ' not in epdLine:
-                    print('Warning!! epd \"%s\"')
-                    print('has no bm opcode - skipped.\n')
-                    continue
+            # Get the first 4 fields [pieces side castle_flag ep_sq],
+            # also search the hmvc opcode.
+            epdLineSplit = epdLine.split()
+            epd = ' '.join(epdLineSplit[0:4])
+            hmvc = self.GetHmvcInEpd(epdLine)
 
-                # Get the bm(s) move in the epd line, epdBm is a list.
-                epdBm = self.GetEpdBm(epdLineSplit)                
+            # Add hmvc and fmvn to create a FEN for the engine.
+            fen = epd + ' ' + hmvc + ' 1'
 
-                # Get engine analysis, we are only interested on bm.
+            # Show progress in console.
+            print('EPD %d: %s' %(cntEpd, epdLine))
+            print('FEN %d: %s' %(cntEpd, fen))
+
+            # If this position has no legal move then we skip it.
+            pos = chess.Board(fen)
+            isGameOver = pos.is_checkmate() or pos.is_stalemate()
+            if isGameOver:
+                # Show warning in console.
+                print('Warning! epd \"%s\"' %(epd))
+                print('has no legal move - skipped.\n')
+                continue
+
+            # If the epd line has no bm then we just skip it.
+            if 'bm ' not in epdLine:
+                print('Warning!! epd \"%s\"')
+                print('has no bm opcode - skipped.\n')
+                continue
+
+            # Get the bm(s) move in the epd line, epdBm is a list.
+            epdBm = self.GetEpdBm(epdLineSplit)                
+
+            # Get engine analysis, we are only interested on bm.
+            # With triage the only legal move is the bm.
+            if self.triageOpt == 'on' and pos.legal_moves.count() == 1:
+                bm = pos.san(list(pos.legal_moves)[0])
+                cntAvoided += 1
+            else:
                 _, _, bm, _ = self.GetEpdEngineSearchScore(fen)
-                
-                # The percentage correct is based on valid epd only
-                cntValidEpd += 1
+            
+            # The percentage correct is based on valid epd only
+            cntValidEpd += 1
 
-                # Show progress in console.
-                print('engine bm: %s' %(bm))
+            # Show progress in console.
+            print('engine bm: %s' %(bm))
 
-                # Check bm of engine against the bm in epd, if found count it.
-                isCorrect = self.IsCorrectEngineBm(bm, epdBm)
-                if isCorrect:
-                    cntCorrect += 1
-                    print('correct: %d' %(cntCorrect))
-                print
+            # Check bm of engine against the bm in epd, if found count it.
+            isCorrect = self.IsCorrectEngineBm(bm, epdBm)
+            if isCorrect:
+                cntCorrect += 1
+                print('correct: %d' %(cntCorrect))
+            print
 
         # Print test summary.
         cntWrong = cntValidEpd - cntCorrect
@@ -1719,6 +3489,8 @@ class Analyze():
         print('Total tested positions: %d' %(cntValidEpd))
         print('Total correct         : %d' %(cntCorrect))
         print('Correct percentage    : %0.1f' %(pctCorrect))
+        if self.triageOpt == 'on':
+            print('Triage searches avoided: %d' %(cntAvoided))
 
         # Write to output file, that was specified in -outfile option.
         with open(self.outfn, 'a') as f:
@@ -1729,7 +3501,1141 @@ class Analyze():
             f.write('Total tested positions: %d\n' %(cntValidEpd))
             f.write('Total correct         : %d\n' %(cntCorrect))
             f.write('Correct percentage    : %0.1f\n' %(pctCorrect))
+
+    def SolveEpdWithEngine(self):
+        """ Test engine with epd test suite and measure the time to
+            solution of each position. The search is stopped once the
+            solution is stable, results will be in the output file.
+        """
+        cntEpd = 0
+        results = []
+        
+        # Read the lines of the epd file.
+        for lines in ReadFileLines(self.infn):
+            cntEpd += 1
             
+            # Remove white space at beginning and end of lines.
+            epdLine = lines.strip()
+            if not epdLine:
+                continue
+
+            # Get the first 4 fields [pieces side castle_flag ep_sq],
+            # also search the hmvc opcode.
+            epdLineSplit = epdLine.split()
+            epd = ' '.join(epdLineSplit[0:4])
+            hmvc = self.GetHmvcInEpd(epdLine)
+
+            # Add hmvc and fmvn to create a FEN for the engine.
+            fen = epd + ' ' + hmvc + ' 1'
+
+            # Show progress in console.
+            print('EPD %d: %s' %(cntEpd, epdLine))
+
+            # If this position has no legal move then we skip it.
+            pos = chess.Board(fen)
+            isGameOver = pos.is_checkmate() or pos.is_stalemate()
+            if isGameOver:
+                # Show warning in console.
+                print('Warning! epd \"%s\"' %(epd))
+                print('has no legal move - skipped.\n')
+                continue
+
+            # The epd line should have a bm or an am opcode.
+            epdBm, epdAm = [], []
+            if 'bm' in epdLineSplit:
+                epdBm = self.GetEpdBm(epdLineSplit)
+            elif 'am' in epdLineSplit:
+                epdAm = self.GetEpdBm(epdLineSplit, 'am')
+            else:
+                print('Warning!! epd \"%s\"' %(epd))
+                print('has no bm or am opcode - skipped.\n')
+                continue
+
+            solveTime, solveDepth, bm, depth, searchTime =\
+                       self.GetEpdSolveTime(fen, epdBm, epdAm)
+            epdId = self.GetIdInEpd(epdLine)
+            if epdId is None:
+                epdId = str(cntEpd)
+            results.append((epdId, solveTime, solveDepth, bm,
+                            depth, searchTime))
+
+            # Show progress in console.
+            if solveTime is None:
+                print('engine bm: %s, not solved\n' %(bm))
+            else:
+                print('engine bm: %s, solved in %0.2fs at depth %d\n'\
+                      %(bm, solveTime/1000.0, solveDepth))
+
+        # The solved positions at each time, the time is doubled
+        # from point to point up to the movetime.
+        solveTimes = [r[1] for r in results if r[1] is not None]
+        curve = []
+        for i in range(SOLVE_CURVE_POINTS - 1, -1, -1):
+            t = self.moveTimeOpt / 2**i
+            curve.append((t, len([s for s in solveTimes if s <= t])))
+        cntSolved = len(solveTimes)
+        pctSolved = 0.0
+        if results:
+            pctSolved = (100.0 * cntSolved)/len(results)
+        totalTime = sum([r[5] for r in results])
+
+        # Write to output file, that was specified in -outfile option.
+        with open(self.outfn, 'a') as f:
+            f.write(':: EPD %s SOLVE TIME RESULTS ::\n' %(self.infn))
+            f.write('Engine          : %s\n' %(self.engIdName))
+            f.write('Time/pos (sec)  : %0.1f\n' %(self.moveTimeOpt/1000.0))
+            f.write('Stable depths   : %d\n\n' %(self.stableDepthOpt))
+            f.write('%-16s %-8s %10s %6s %8s %8s\n'\
+                    %('id', 'bm', 'solve(s)', 'depth', 'acd', 'acs(s)'))
+            for epdId, solveTime, solveDepth, bm, depth, searchTime in results:
+                if solveTime is None:
+                    f.write('%-16s %-8s %10s %6s %8d %8.2f\n'\
+                            %(epdId, bm, '-', '-', depth, searchTime/1000.0))
+                else:
+                    f.write('%-16s %-8s %10.2f %6d %8d %8.2f\n'\
+                            %(epdId, bm, solveTime/1000.0, solveDepth,
+                              depth, searchTime/1000.0))
+            f.write('\nSolved vs time\n')
+            for t, cnt in curve:
+                f.write('%8.3fs : %d\n' %(t/1000.0, cnt))
+            f.write('\nTotal tested positions: %d\n' %(len(results)))
+            f.write('Total solved          : %d\n' %(cntSolved))
+            f.write('Solved percentage     : %0.1f\n' %(pctSolved))
+            f.write('Total search time (s) : %0.1f of %0.1f\n'\
+                    %(totalTime/1000.0,
+                      len(results) * self.moveTimeOpt/1000.0))
+
+        # Print summary to console
+        print(':: EPD %s SOLVE TIME RESULTS ::\n' %(self.infn))
+        print('Total tested positions: %d' %(len(results)))
+        print('Total solved          : %d' %(cntSolved))
+        print('Solved percentage     : %0.1f' %(pctSolved))
+
+    def GetComparePositions(self, fileType):
+        """ Returns a list of (id, fen, epdBm, epdAm) of the positions
+            in the input file. From a pgn file the positions before the
+            moves from moveStartOpt are taken, they have no bm or am and
+            epdBm and epdAm are None.
+        """
+        positions = []
+        if fileType == PGN_FILE:
+            gameCnt = 0
+            for game in self.ReadGames():
+                gameCnt += 1
+                for p in self.GetGamePlies(game):
+                    if p['fmvn'] < self.moveStartOpt or p['isGameOver']:
+                        continue
+                    posId = '%d:%d%s' %(gameCnt, p['fmvn'],
+                                        '.' if p['side'] else '...')
+                    positions.append((posId, p['fenBeforeMove'], None, None))
+            return positions
+
+        cntEpd = 0
+        for lines in ReadFileLines(self.infn):
+            cntEpd += 1
+            epdLine = lines.strip()
+            if not epdLine:
+                continue
+            epdLineSplit = epdLine.split()
+            epd = ' '.join(epdLineSplit[0:4])
+            fen = epd + ' ' + self.GetHmvcInEpd(epdLine) + ' 1'
+
+            # If this position has no legal move then we skip it.
+            pos = chess.Board(fen)
+            if pos.is_checkmate() or pos.is_stalemate():
+                print('Warning! epd \"%s\"' %(epd))
+                print('has no legal move - skipped.\n')
+                continue
+
+            epdBm, epdAm = None, None
+            if 'bm' in epdLineSplit:
+                epdBm, epdAm = self.GetEpdBm(epdLineSplit), []
+            elif 'am' in epdLineSplit:
+                epdBm, epdAm = [], self.GetEpdBm(epdLineSplit, 'am')
+            epdId = self.GetIdInEpd(epdLine)
+            if epdId is None:
+                epdId = str(cntEpd)
+            positions.append((epdId, fen, epdBm, epdAm))
+        return positions
+
+class SharedCache():
+    """ A table of engine results in a memory mapped file that is shared
+        by the worker processes of a computer. The slot of a result is
+        found by the zobrist key of the position and a salt of the kind
+        of query and its movetime, SHARED_CACHE_PROBES slots are tried.
+        There is no lock, the key of a slot is saved xor the checksum of
+        its data, so a slot that another process is writing does not
+        match and is a miss.
+    """
+    def __init__(self, fn, sizeMb, optionsKey):
+        """ Opens the table of fn, it is created if it is missing. A table
+            of other options or size is not used.
+        """
+        self.slotCnt = max(SHARED_CACHE_PROBES, sizeMb * 1024 * 1024\
+                           / SHARED_CACHE_SLOT_SIZE)
+        size = SHARED_CACHE_HEADER_SIZE + self.slotCnt * SHARED_CACHE_SLOT_SIZE
+        header = ('chess-artist %s %d\n' %(optionsKey, self.slotCnt))\
+                 .ljust(SHARED_CACHE_HEADER_SIZE)
+        if not os.path.isfile(fn):
+            tmpFile = '%s.%d' %(fn, os.getpid())
+            with open(tmpFile, 'wb') as f:
+                f.write(header)
+                f.truncate(size)
+
+            # Another process may have created it first.
+            try:
+                if hasattr(os, 'link'):
+                    os.link(tmpFile, fn)
+                else:
+                    os.rename(tmpFile, fn)
+            except OSError:
+                pass
+            DeleteFile(tmpFile)
+        if os.path.getsize(fn) != size:
+            raise ValueError('%s has another size' %(fn))
+        with open(fn, 'r+b') as f:
+            self.data = mmap.mmap(f.fileno(), 0)
+        if self.data[:SHARED_CACHE_HEADER_SIZE] != header:
+            self.data.close()
+            raise ValueError('%s has other options' %(fn))
+        self.salts = {}
+        self.hits, self.misses, self.stores = 0, 0, 0
+
+    def GetKey(self, kind, pos, moveTime):
+        """ Returns the key of a query of kind on pos with moveTime """
+        if (kind, moveTime) not in self.salts:
+            salt = hashlib.sha1('%s %d' %(kind, moveTime)).hexdigest()
+            self.salts[(kind, moveTime)] = int(salt[:16], 16)
+        zobrist = chess.polyglot.zobrist_hash(chess.Board(pos))
+        return (zobrist ^ self.salts[(kind, moveTime)]) or 1
+
+    def ReadSlot(self, i):
+        """ Returns the key and the words of the data of slot i """
+        offset = SHARED_CACHE_HEADER_SIZE + i * SHARED_CACHE_SLOT_SIZE
+        raw = self.data[offset:offset + SHARED_CACHE_SLOT_SIZE]
+        words = struct.unpack('<8Q', raw)
+        checksum = 0
+        for w in words[1:]:
+            checksum ^= w
+        return words[0] ^ checksum, raw[8:]
+
+    def Get(self, key):
+        """ Returns the record of key or None """
+        for n in range(SHARED_CACHE_PROBES):
+            slotKey, raw = self.ReadSlot((key + n) % self.slotCnt)
+            if slotKey == key:
+                self.hits += 1
+                return struct.unpack(SHARED_CACHE_DATA, raw)
+        self.misses += 1
+        return None
+
+    def Put(self, key, record):
+        """ Saves record in the slot of key, an empty slot or the slot of
+            the lowest depth is used when key is not in the table.
+        """
+        raw = struct.pack(SHARED_CACHE_DATA, *record)
+        checksum = 0
+        for w in struct.unpack('<7Q', raw):
+            checksum ^= w
+        best, bestDepth = None, None
+        for n in range(SHARED_CACHE_PROBES):
+            i = (key + n) % self.slotCnt
+            slotKey, slotRaw = self.ReadSlot(i)
+            if slotKey == key or slotRaw == '\0' * len(slotRaw):
+                best = i
+                break
+            depth = struct.unpack(SHARED_CACHE_DATA, slotRaw)[1]
+            if bestDepth is None or depth < bestDepth:
+                best, bestDepth = i, depth
+        offset = SHARED_CACHE_HEADER_SIZE + best * SHARED_CACHE_SLOT_SIZE
+        self.data[offset:offset + SHARED_CACHE_SLOT_SIZE] =\
+                                  struct.pack('<Q', key ^ checksum) + raw
+        self.stores += 1
+
+    def GetReport(self):
+        """ Returns the hits, misses and hit rate as a string """
+        queries = self.hits + self.misses
+        return 'Shared cache: %d hits, %d misses, hit rate %0.1f%%, %d stored'\
+               %(self.hits, self.misses,
+                 100.0 * self.hits / max(1, queries), self.stores)
+
+
+class WorkQueue():
+    """ A queue of annotation jobs in a directory shared by a coordinator
+        and its workers. A job is a file in todo, a worker leases it by
+        renaming it to leased and keeps the lease by touching the file.
+        Results are saved in done. The coordinator puts a job back to
+        todo when its lease is not renewed within leaseTime seconds.
+    """
+    def __init__(self, queueDir, leaseTime=DEFAULT_LEASE_TIME):
+        """ Initialize """
+        self.queueDir = queueDir
+        self.leaseTime = leaseTime
+        self.todoDir = os.path.join(queueDir, 'todo')
+        self.leasedDir = os.path.join(queueDir, 'leased')
+        self.doneDir = os.path.join(queueDir, 'done')
+        self.optionsFile = os.path.join(queueDir, 'options.txt')
+        self.finishedFile = os.path.join(queueDir, 'finished')
+
+    def Create(self, options):
+        """ Creates an empty queue and saves the annotation options
+            that will be used by the workers.
+        """
+        for d in [self.todoDir, self.leasedDir, self.doneDir]:
+            if os.path.isdir(d):
+                for fn in os.listdir(d):
+                    DeleteFile(os.path.join(d, fn))
+            else:
+                os.makedirs(d)
+        DeleteFile(self.finishedFile)
+
+        # Write the options file last, workers wait for it.
+        tmpFile = self.optionsFile + '.tmp'
+        with open(tmpFile, 'w') as f:
+            for k in sorted(options):
+                f.write('%s %s\n' %(k, options[k]))
+        DeleteFile(self.optionsFile)
+        os.rename(tmpFile, self.optionsFile)
+
+    def ReadOptions(self):
+        """ Returns the annotation options saved by the coordinator """
+        opt = []
+        with open(self.optionsFile, 'r') as f:
+            for line in f:
+                opt.extend(line.strip().split(None, 1))
+        return EvaluateOptions(opt)
+
+    def IsCreated(self):
+        """ Returns True if the coordinator has created the queue """
+        return os.path.isfile(self.optionsFile)
+
+    def AddJob(self, jobName, text):
+        """ Saves the job text in todo. It is written to a temp file
+            first so that a worker will never read a partial job.
+        """
+        tmpFile = os.path.join(self.queueDir, '.' + jobName)
+        with open(tmpFile, 'w') as f:
+            f.write(text)
+        os.rename(tmpFile, os.path.join(self.todoDir, jobName))
+
+    def LeaseJob(self, workerId):
+        """ Returns the job name and its lease file, or None, None
+            if there is no job to do.
+        """
+        for jobName in sorted(os.listdir(self.todoDir)):
+            todoFile = os.path.join(self.todoDir, jobName)
+            leaseFile = os.path.join(self.leasedDir, jobName + '@' + workerId)
+            try:
+                # Start the lease time before the rename, so the
+                # coordinator will not see an expired lease.
+                os.utime(todoFile, None)
+                os.rename(todoFile, leaseFile)
+            except OSError:
+                # Another worker got this job first.
+                continue
+            return jobName, leaseFile
+        return None, None
+
+    def RenewLease(self, leaseFile):
+        """ Returns False if the lease was lost """
+        try:
+            os.utime(leaseFile, None)
+        except OSError:
+            return False
+        return True
+
+    def CompleteJob(self, jobName, leaseFile, resultFile):
+        """ Saves the result of the job and releases its lease """
+        doneFile = os.path.join(self.doneDir, jobName)
+
+        # The job may have been reissued and completed by another worker.
+        if os.path.isfile(doneFile):
+            DeleteFile(resultFile)
+        else:
+            os.rename(resultFile, doneFile)
+        DeleteFile(leaseFile)
+
+    def RequeueExpiredJobs(self):
+        """ Puts back the jobs whose lease has expired, returns the
+            number of jobs that were put back.
+        """
+        cnt = 0
+        now = time.time()
+        for leaseName in os.listdir(self.leasedDir):
+            leaseFile = os.path.join(self.leasedDir, leaseName)
+            try:
+                if now - os.path.getmtime(leaseFile) <= self.leaseTime:
+                    continue
+                jobName = leaseName.split('@')[0]
+                if os.path.isfile(os.path.join(self.doneDir, jobName)):
+                    DeleteFile(leaseFile)
+                else:
+                    os.rename(leaseFile, os.path.join(self.todoDir, jobName))
+                    cnt += 1
+            except OSError:
+                # The worker has just completed or renewed it.
+                continue
+        return cnt
+
+    def GetResultFile(self, jobName):
+        """ Returns the result file of the job or None if not done yet """
+        doneFile = os.path.join(self.doneDir, jobName)
+        if os.path.isfile(doneFile):
+            return doneFile
+        return None
+
+    def Finish(self):
+        """ Tells the workers that there will be no more jobs """
+        with open(self.finishedFile, 'w') as f:
+            f.write('finished\n')
+
+    def IsFinished(self):
+        """ Returns True if the coordinator has finished """
+        return os.path.isfile(self.finishedFile)
+
+
+def ReadPgnGameTexts(infn):
+    """ Yields the text of each game in pgn file infn. The moves are not
+        parsed, a game ends when a tag line is found after its movetext.
+    """
+    data = MapFile(infn)
+    if not data:
+        return
+    try:
+        for start, end in GetPgnGameOffsets(data):
+            yield data[start:end]
+    finally:
+        data.close()
+
+
+def RunReadBenchmark(infn):
+    """ Reads the games of pgn file infn with chess.pgn.read_game and
+        with ReadMainLineGame, and prints the time, the nodes and moves
+        kept by each reader and the games whose main lines differ.
+    """
+    texts = list(ReadPgnGameTexts(infn))
+    print('Games: %d, size: %d bytes' %(len(texts), sum(map(len, texts))))
+    texts.extend(READBENCH_CHECK_GAMES)
+    print('Check games: %d' %(len(READBENCH_CHECK_GAMES)))
+
+    t1 = time.time()
+    mainLines, nodeCnt = [], 0
+    for text in texts:
+        game = chess.pgn.read_game(StringIO(text))
+        if game is None:
+            mainLines.append(None)
+            continue
+        mainLines.append([m.uci() for m in game.main_line()])
+        nodes = [game]
+        while nodes:
+            node = nodes.pop()
+            nodeCnt += 1
+            nodes.extend(node.variations)
+    readGameTime = time.time() - t1
+
+    t1 = time.time()
+    diffCnt, moveCnt = 0, 0
+    for text, mainLine in zip(texts, mainLines):
+        game = ReadMainLineGame(text)
+        if game is None:
+            diffCnt += mainLine is not None
+            continue
+        moveCnt += len(game.moves)
+        if mainLine != [m.uci() for m in game.main_line()]:
+            diffCnt += 1
+    mainLineTime = time.time() - t1
+
+    print('read_game       : %0.3fs, %d nodes' %(readGameTime, nodeCnt))
+    print('ReadMainLineGame: %0.3fs, %d moves in %d bytes'\
+          %(mainLineTime, moveCnt, moveCnt * 2))
+    if mainLineTime > 0:
+        print('Speedup: %0.2fx' %(readGameTime / mainLineTime))
+    print('Games with a different main line: %d' %(diffCnt))
+
+
+def ReadInputJobs(infn, fileType, jobSize):
+    """ Yields the text of jobs, a job has jobSize games for pgn file
+        or jobSize lines for epd file.
+    """
+    if fileType == PGN_FILE:
+        texts = ReadPgnGameTexts(infn)
+    else:
+        texts = ReadFileLines(infn)
+
+    job = []
+    for text in texts:
+        if fileType == EPD_FILE and not text.strip():
+            continue
+
+        # Make sure the next game or line will not be joined to this one.
+        if not text.endswith('\n'):
+            text += '\n'
+        if fileType == PGN_FILE and not text.endswith('\n\n'):
+            text += '\n'
+        job.append(text)
+        if len(job) >= jobSize:
+            yield ''.join(job)
+            job = []
+    if job:
+        yield ''.join(job)
+
+
+def RunCoordinator(infn, outfn, fileType, options, queueDir, leaseTime,
+                   numWorkers, jobSize, engineName, engOption):
+    """ Splits the input file into jobs in queueDir, waits for the
+        workers to annotate them and writes the results to outfn in
+        the same order as the input. numWorkers local worker processes
+        are started, workers on other computers can join any time with
+        -role worker and the same -queuedir.
+    """
+    queue = WorkQueue(queueDir, leaseTime)
+    queueOptions = dict(options)
+    queueOptions['-lease'] = leaseTime
+    del queueOptions['-engoptions']
+    queue.Create(queueOptions)
+
+    # Create the jobs.
+    ext = '.pgn' if fileType == PGN_FILE else '.epd'
+    jobNames = []
+    for text in ReadInputJobs(infn, fileType, jobSize):
+        jobName = '%08d%s' %(len(jobNames), ext)
+        queue.AddJob(jobName, text)
+        jobNames.append(jobName)
+    print('Coordinator: %d jobs in %s' %(len(jobNames), queueDir))
+
+    # Start local workers, their console output is saved in the queue dir.
+    workers = []
+    for i in range(numWorkers):
+        logFile = open(os.path.join(queueDir, 'worker%d.log' %(i+1)), 'w')
+        cmd = [sys.executable, os.path.abspath(__file__),
+               '-role', 'worker', '-queuedir', queueDir,
+               '-eng', engineName, '-engoptions', engOption]
+        workers.append(subprocess.Popen(cmd, stdout=logFile,
+                                        stderr=subprocess.STDOUT))
+        logFile.close()
+
+    # Write the results in order as soon as they are available.
+    jobIndex = 0
+    while jobIndex < len(jobNames):
+        resultFile = queue.GetResultFile(jobNames[jobIndex])
+        if resultFile is not None:
+            with open(resultFile, 'r') as f:
+                with open(outfn, 'a') as f1:
+                    f1.write(f.read())
+            DeleteFile(resultFile)
+            jobIndex += 1
+            print('Coordinator: job %d/%d done' %(jobIndex, len(jobNames)))
+            continue
+
+        cnt = queue.RequeueExpiredJobs()
+        if cnt:
+            print('Coordinator: %d expired job(s) reissued' %(cnt))
+
+        # Quit if all local workers are gone and there are no others.
+        if workers and all(w.poll() is not None for w in workers)\
+           and not os.listdir(queue.leasedDir):
+            print('Error! all local workers have stopped, see %s'\
+                  %(os.path.join(queueDir, 'worker1.log')))
+            break
+        time.sleep(QUEUE_POLL_TIME)
+
+    queue.Finish()
+    for w in workers:
+        w.wait()
+
+
+def RunWorker(queueDir, engineName, engOption):
+    """ Annotates jobs from queueDir with the local engine until the
+        coordinator has finished.
+    """
+    workerId = '%s-%d' %(socket.gethostname(), os.getpid())
+    queue = WorkQueue(queueDir)
+
+    # Wait for the coordinator.
+    while not queue.IsCreated():
+        time.sleep(QUEUE_POLL_TIME)
+
+    # Get the annotation options from the coordinator.
+    opt = queue.ReadOptions()
+    queue.leaseTime = GetOptionValue(opt, '-lease', DEFAULT_LEASE_TIME)
+    options = {}
+    for k, v in ANALYZE_OPTIONS.items():
+        options[k] = GetOptionValue(opt, k, v)
+
+    # The engine options are of this worker, and the outputs that only
+    # the coordinator writes are not used.
+    for k in ['-stabledepth', '-records', '-incremental', '-watch', '-poll',
+              '-latency']:
+        options[k] = ANALYZE_OPTIONS[k]
+    options['-engoptions'] = engOption
+    if options['-book'] == 'cerebellum' and\
+       not os.path.isfile('Cerebellum_Light.bin'):
+        options['-book'] = 'none'
+        print('Warning! cerebellum book is missing.')
+
+    g = None
+    while True:
+        jobName, leaseFile = queue.LeaseJob(workerId)
+        if jobName is None:
+            if queue.IsFinished():
+                break
+            time.sleep(QUEUE_POLL_TIME)
+            continue
+        print('Worker %s: job %s' %(workerId, jobName))
+
+        resultFile = os.path.join(queueDir, '.%s@%s' %(jobName, workerId))
+        DeleteFile(resultFile)
+        if g is None:
+            g = Analyze(leaseFile, resultFile, engineName, **options)
+            g.PrintEngineIdName()
+        g.infn, g.outfn = leaseFile, resultFile
+
+        # Renew the lease while the job is being annotated.
+        isJobDone = threading.Event()
+        def KeepLease():
+            while not isJobDone.wait(queue.leaseTime/4.0):
+                if not queue.RenewLease(leaseFile):
+                    break
+        t = threading.Thread(target=KeepLease)
+        t.daemon = True
+        t.start()
+
+        if jobName.endswith('.epd'):
+            g.AnnotateEpd()
+        else:
+            g.AnnotatePgn()
+
+        isJobDone.set()
+        t.join()
+
+        # There is no output when all positions in the job were skipped.
+        if not os.path.isfile(resultFile):
+            open(resultFile, 'w').close()
+        queue.CompleteJob(jobName, leaseFile, resultFile)
+
+class AnalysisClient():
+    """ A connection to the analysis server. The replies of the engine
+        threads are sent as json lines, one at a time.
+    """
+    def __init__(self, conn, clientId):
+        """ Initialize """
+        self.conn = conn
+        self.clientId = clientId
+        self.tasks = collections.deque()
+        self.lock = threading.Lock()
+        self.isClosed = False
+
+    def Send(self, reply):
+        """ Sends reply, nothing is sent after the client has left """
+        with self.lock:
+            if self.isClosed:
+                return
+            try:
+                self.conn.sendall(json.dumps(reply, sort_keys=True) + '\n')
+            except socket.error:
+                self.isClosed = True
+
+    def Close(self):
+        """ Closes the connection """
+        with self.lock:
+            self.isClosed = True
+            self.conn.close()
+
+
+class AnalysisServer():
+    """ Analyzes the requests of the clients of a local TCP socket with a
+        pool of engines that are kept running. A request is a json line:
+        {"id": 1, "type": "position", "fen": "<fen>", "movetime": 500}
+        {"id": 2, "type": "epd", "lines": ["<epd or fen>", ...]}
+        {"id": 3, "type": "game", "pgn": "<pgn text>"}
+        {"type": "stats"}
+        The result of each position or ply is sent as soon as it is done
+        and {"id": 1, "done": true} after the last one, or with the error
+        of a request. A position that is
+        queued or searched for another request is not searched again, and
+        the engines take the queued tasks of the clients in turn.
+    """
+    def __init__(self, engineName, options, poolSize):
+        """ Initialize, the engines are started here """
+        opt = dict(options)
+        opt['-session'] = 'game'
+        opt['-records'] = 'none'
+        self.moveTime = opt['-movetime']
+        self.analyzers = []
+        for i in range(poolSize):
+            g = Analyze(None, None, engineName, **opt)
+            g.CheckEngineCapabilities()
+            g.StartEngine()
+            self.analyzers.append(g)
+        self.cond = threading.Condition()
+        self.clients = []
+        self.turn = 0
+
+        # The requests that wait for each position being searched, and
+        # the number of results that each request still waits for.
+        self.searches = {}
+        self.remaining = {}
+        self.requestCnt = 0
+        self.searchCnt = 0
+        self.coalescedCnt = 0
+
+    def GetFen(self, line):
+        """ Returns the fen of a fen or epd line """
+        fields = line.split()
+        if len(fields) >= 6 and fields[4].isdigit() and fields[5].isdigit():
+            return ' '.join(fields[0:6])
+        return ' '.join(fields[0:4]) + ' 0 1'
+
+    def AddRequest(self, client, request):
+        """ Queues the tasks of a request. A position that is already
+            queued or searched only adds the request to its waiters.
+        """
+        reqId = request.get('id')
+        kind = request.get('type')
+        moveTime = int(request.get('movetime', self.moveTime))
+        if kind == 'position':
+            lines = [request['fen']]
+        elif kind == 'epd':
+            lines = request['lines']
+        elif kind == 'game':
+            lines = None
+        else:
+            client.Send({'id': reqId, 'error': 'unknown type %s' %(kind),
+                         'done': True})
+            return
+
+        # There is nothing to analyze in an empty epd request.
+        if lines == []:
+            client.Send({'id': reqId, 'done': True})
+            return
+
+        with self.cond:
+            self.requestCnt += 1
+            token = self.requestCnt
+            if lines is None:
+                self.remaining[token] = 1
+                client.tasks.append(('game', token, reqId, request['pgn']))
+            else:
+                self.remaining[token] = len(lines)
+                for index, line in enumerate(lines):
+                    fen = self.GetFen(line)
+                    key = (fen.rsplit(' ', 1)[0], moveTime)
+                    waiter = (client, token, reqId, index, line)
+                    if key in self.searches:
+                        self.searches[key].append(waiter)
+                        self.coalescedCnt += 1
+                        continue
+                    self.searches[key] = [waiter]
+                    client.tasks.append(('position', key, fen, moveTime))
+            self.cond.notify_all()
+
+    def GetTask(self):
+        """ Returns the next task, the clients that have tasks are taken in
+            turn. A client that has left is kept until its tasks are done,
+            other clients may wait for them.
+        """
+        with self.cond:
+            while True:
+                self.clients = [c for c in self.clients
+                                if c.tasks or not c.isClosed]
+                for i in range(len(self.clients)):
+                    client = self.clients[(self.turn + i) % len(self.clients)]
+                    if client.tasks:
+                        self.turn = (self.turn + i + 1) % len(self.clients)
+                        return client, client.tasks.popleft()
+                self.cond.wait()
+
+    def FinishTask(self, client, token, reqId):
+        """ Sends done when the last result of a request is sent """
+        with self.cond:
+            self.remaining[token] -= 1
+            isDone = not self.remaining[token]
+            if isDone:
+                del self.remaining[token]
+        if isDone:
+            client.Send({'id': reqId, 'done': True})
+
+    def AnalyzePositionTask(self, g, key, fen, moveTime):
+        """ Searches fen and sends the result to every waiting request.
+            The waiters get an error reply when the search fails, so the
+            position is never left to a search that has ended.
+        """
+        reply = {'error': 'search failed'}
+        try:
+            board = chess.Board(fen)
+        except ValueError:
+            board = None
+            reply = {'error': 'invalid fen'}
+        try:
+            if board is None:
+                pass
+            elif not board.legal_moves.count():
+                reply = {'error': 'position has no legal move'}
+            else:
+                bestMove, score, _, _, pvLine, stats =\
+                          g.GetSearchScoreBeforeMove(fen, board.turn,
+                                                     None, moveTime)
+                reply = {'bestMove': bestMove, 'score': score,
+                         'pv': pvLine[1], 'depth': stats['depth'],
+                         'nodes': stats['nodes'], 'time': stats['time']}
+                with self.cond:
+                    self.searchCnt += 1
+        except Exception as e:
+            reply = {'error': 'search failed: %s' %(e)}
+        finally:
+            with self.cond:
+                waiters = self.searches.pop(key, [])
+            for client, token, reqId, index, line in waiters:
+                r = dict(reply)
+                r.update({'id': reqId, 'index': index, 'fen': line})
+                client.Send(r)
+                self.FinishTask(client, token, reqId)
+
+    def AnalyzeGameTask(self, g, client, token, reqId, pgn):
+        """ Sends the record of each ply of the game as it is analyzed """
+        game = None
+        try:
+            game = ReadMainLineGame(pgn.encode('utf-8'))
+        except ValueError:
+            pass
+        try:
+            if game is None:
+                client.Send({'id': reqId, 'error': 'invalid pgn'})
+            else:
+                g.outfn = None
+                for record in g.AnnotateGamePlies(game):
+                    client.Send({'id': reqId, 'record': record})
+                    if client.isClosed:
+                        break
+        except Exception as e:
+            client.Send({'id': reqId, 'error': 'analysis failed: %s' %(e)})
+        finally:
+            self.FinishTask(client, token, reqId)
+
+    def Work(self, g):
+        """ Runs the tasks with the engine of the analyzer g """
+        while True:
+            client, task = self.GetTask()
+            if task[0] == 'game':
+                self.AnalyzeGameTask(g, client, *task[1:])
+            else:
+                self.AnalyzePositionTask(g, *task[1:])
+
+    def HandleClient(self, conn, clientId):
+        """ Reads the requests of a client until it leaves """
+        client = AnalysisClient(conn, clientId)
+        with self.cond:
+            self.clients.append(client)
+        for line in iter(conn.makefile('r').readline, ''):
+            if not line.strip():
+                continue
+            request = None
+            try:
+                request = json.loads(line)
+                if request.get('type') == 'stats':
+                    with self.cond:
+                        stats = {'id': request.get('id'),
+                                 'engines': len(self.analyzers),
+                                 'clients': len(self.clients),
+                                 'searches': self.searchCnt,
+                                 'coalesced': self.coalescedCnt,
+                                 'done': True}
+                    client.Send(stats)
+                    continue
+                self.AddRequest(client, request)
+            except (ValueError, KeyError, TypeError, AttributeError):
+                reqId = None
+                if isinstance(request, dict):
+                    reqId = request.get('id')
+                client.Send({'id': reqId,
+                             'error': 'invalid request %s' %(line.strip()),
+                             'done': True})
+        client.Close()
+
+    def Serve(self, port):
+        """ Accepts clients on port of localhost until Ctrl+C is pressed """
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.bind(('127.0.0.1', port))
+        server.listen(16)
+        for g in self.analyzers:
+            t = threading.Thread(target=self.Work, args=(g,))
+            t.daemon = True
+            t.start()
+        print('Server on port %d with %d engines, press Ctrl+C to stop.'\
+              %(port, len(self.analyzers)))
+
+        clientCnt = 0
+        try:
+            while True:
+                conn, _ = server.accept()
+                clientCnt += 1
+                t = threading.Thread(target=self.HandleClient,
+                                     args=(conn, clientCnt))
+                t.daemon = True
+                t.start()
+        except KeyboardInterrupt:
+            print('Server stopped: %d clients, %d searches, %d positions coalesced'\
+                  %(clientCnt, self.searchCnt, self.coalescedCnt))
+        server.close()
+
+
+def RunServer(engineName, options, port, poolSize):
+    """ Runs the analysis server with poolSize engines """
+    server = AnalysisServer(engineName, options, max(1, poolSize))
+    server.Serve(port)
+
+
+def GetEngineThreads(engOption):
+    """ Returns the Threads value in engOption """
+    for opt in engOption.split(','):
+        optList = opt.split()
+        if len(optList) == 3 and optList[0] == 'Threads':
+            return int(optList[2])
+    return DEFAULT_THREADS
+
+def RunEngineComparison(infn, outfn, fileType, options, engineNames,
+                        engOptions, numCores):
+    """ Searches the positions of infn with each engine and writes a side
+        by side report to outfn. The positions are read once. The searches
+        of all engines are run at the same time, a search is started when
+        there are free cores for its engine threads.
+    """
+    analyzers = []
+    for engineName, engOption in zip(engineNames, engOptions):
+        opt = dict(options)
+        opt['-engoptions'] = engOption
+        analyzers.append(Analyze(infn, outfn, engineName, **opt))
+    positions = analyzers[0].GetComparePositions(fileType)
+
+    # The searches of the engines on a position are next to each other
+    # so that all engines progress together.
+    tasks = []
+    for i in range(len(positions)):
+        for j in range(len(analyzers)):
+            tasks.append((i, j))
+    tasks.reverse()
+    results = [[None] * len(analyzers) for _ in positions]
+    engThreads = [min(numCores, GetEngineThreads(o)) for o in engOptions]
+    freeCores = [numCores]
+    cond = threading.Condition()
+    print('Comparing %d engines on %d positions with %d cores\n'\
+          %(len(analyzers), len(positions), numCores))
+
+    def Search(i, j):
+        stats = {'nodes': 0, 'nps': 0}
+        try:
+            acd, _, bm, ce = analyzers[j].GetEpdEngineSearchScore(
+                positions[i][1], stats=stats)
+            results[i][j] = (bm, ce, acd, stats['nodes'], stats['nps'],
+                             False)
+        except Exception as e:
+            # A failed search is kept as a row with bm - and the error
+            # flag, it is left out of the summary.
+            print('Error! engine %d failed on %s: %s'\
+                  %(j+1, positions[i][0], e))
+            results[i][j] = ('-', 0, 0, 0, 0, True)
+        finally:
+            with cond:
+                freeCores[0] += engThreads[j]
+                cond.notify_all()
+
+    threads = []
+    with cond:
+        while tasks:
+            i, j = tasks[-1]
+            while freeCores[0] < engThreads[j]:
+                cond.wait()
+            tasks.pop()
+            freeCores[0] -= engThreads[j]
+            t = threading.Thread(target=Search, args=(i, j))
+            t.start()
+            threads.append(t)
+            if len(threads) % 100 == 0:
+                print('Started %d/%d searches'\
+                      %(len(threads), len(positions) * len(analyzers)))
+    for t in threads:
+        t.join()
+
+    # Per position, bm and ce of each engine.
+    with open(outfn, 'a') as f:
+        f.write(':: ENGINE COMPARISON %s ::\n' %(infn))
+        for j, g in enumerate(analyzers):
+            f.write('Engine %d        : %s, %s\n'\
+                    %(j+1, g.engIdName, engOptions[j]))
+        f.write('Time/pos (sec)  : %0.1f\n' %(options['-movetime']/1000.0))
+        f.write('Cores           : %d\n\n' %(numCores))
+        f.write('%-16s' %('id'))
+        for j in range(len(analyzers)):
+            f.write(' %-15s' %('%d: bm ce' %(j+1)))
+        f.write(' agree\n')
+        for i, (posId, _, _, _) in enumerate(positions):
+            f.write('%-16s' %(posId))
+            for bm, ce, _, _, _, isError in results[i]:
+                if isError:
+                    f.write(' %-8s %6s' %(bm, 'error'))
+                else:
+                    f.write(' %-8s %+6d' %(bm, ce))
+            bms = [r[0] for r in results[i] if not r[5]]
+            if len(bms) < 2:
+                f.write(' -\n')
+            else:
+                f.write(' %s\n' %('yes' if len(set(bms)) == 1 else 'no'))
+
+        # Summary of each engine, bm and ce are compared to engine 1.
+        # Failed searches are not counted, agree% and cedelta are over the
+        # positions where both engine 1 and the engine have a result.
+        f.write('\n%-8s %8s %8s %8s %10s %8s %8s %8s\n'\
+                %('engine', 'solved', 'solved%', 'acd', 'knps', 'agree%',
+                  'cedelta', 'failed'))
+        for j in range(len(analyzers)):
+            cntTested, cntSolved, cntAgree, sumDepth, sumNps, sumDelta =\
+                       0, 0, 0, 0, 0, 0
+            cntSearched, cntCompared = 0, 0
+            for i, (_, _, epdBm, epdAm) in enumerate(positions):
+                bm, ce, acd, _, nps, isError = results[i][j]
+                refBm, refCe = results[i][0][0], results[i][0][1]
+                if isError:
+                    continue
+                cntSearched += 1
+                sumDepth += acd
+                sumNps += nps
+                if epdBm is not None:
+                    cntTested += 1
+                    if analyzers[j].IsSolvedMove(bm, epdBm, epdAm):
+                        cntSolved += 1
+                if results[i][0][5]:
+                    continue
+                cntCompared += 1
+                if bm == refBm:
+                    cntAgree += 1
+                ce = max(-COMPARE_SCORE_LIMIT, min(COMPARE_SCORE_LIMIT, ce))
+                refCe = max(-COMPARE_SCORE_LIMIT,
+                            min(COMPARE_SCORE_LIMIT, refCe))
+                sumDelta += abs(ce - refCe)
+            pctSolved = 0.0
+            if cntTested:
+                pctSolved = (100.0 * cntSolved)/cntTested
+            cntFailed = len(positions) - cntSearched
+            cntSearched = max(1, cntSearched)
+            cntCompared = max(1, cntCompared)
+            f.write('%-8d %8d %8.1f %8.1f %10.1f %8.1f %8.1f %8d\n'\
+                    %(j+1, cntSolved, pctSolved, float(sumDepth)/cntSearched,
+                      sumNps/1000.0/cntSearched,
+                      (100.0 * cntAgree)/cntCompared,
+                      float(sumDelta)/cntCompared, cntFailed))
+    print('Report is saved in %s' %(outfn))
+
+
+def GetPhysicalMemory():
+    """ Returns the physical memory in MB or None if it is not known """
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')\
+               / (1024 * 1024)
+    except:
+        return None
+
+def ReadProfile(fn):
+    """ Returns the options in profile fn written by -job calibrate """
+    opt = []
+    with open(fn, 'r') as f:
+        for line in f:
+            if line.strip() and not line.startswith('#'):
+                opt.extend(line.strip().split(None, 1))
+    return EvaluateOptions(opt)
+
+def RunCalibration(infn, outfn, fileType, options, engineName, ramBudget,
+                   depth):
+    """ Measures the positions per second of searches to depth with
+        different numbers of workers, Threads and Hash. The hash of the
+        workers is within ramBudget MB. The best config is written to
+        outfn as a profile that can be loaded with -profile.
+    """
+    numCores = multiprocessing.cpu_count()
+    g = Analyze(infn, outfn, engineName, **options)
+    fens = [p[1] for p in g.GetComparePositions(fileType)]
+    if not fens:
+        print('Error! there are no positions in %s' %(infn))
+        return
+    while len(fens) < CALIBRATE_POSITIONS:
+        fens += fens
+    fens = fens[0:CALIBRATE_POSITIONS]
+
+    def GetHash(workers):
+        """ Returns the largest power of 2 hash in the budget """
+        hashValue = CALIBRATE_MIN_HASH
+        while hashValue * 2 * workers <= ramBudget and\
+              hashValue * 2 <= CALIBRATE_MAX_HASH:
+            hashValue *= 2
+        return hashValue
+
+    def Measure(workers, threads, hashValue):
+        """ Returns positions per second and nps of a config """
+        opt = dict(options)
+        opt['-engoptions'] = 'Hash value %d, Threads value %d'\
+                             %(hashValue, threads)
+        opt['-session'] = 'game'
+        lock = threading.Lock()
+        nextIndex, totalNodes = [0], [0]
+
+        def Work():
+            w = Analyze(infn, outfn, engineName, **opt)
+            while True:
+                with lock:
+                    i = nextIndex[0]
+                    nextIndex[0] += 1
+                if i >= len(fens):
+                    break
+                nodes = w.GetSearchNodesToDepth(fens[i], depth)
+                with lock:
+                    totalNodes[0] += nodes
+            w.QuitSessionEngine()
+
+        startTime = time.time()
+        threadList = [threading.Thread(target=Work) for i in range(workers)]
+        for t in threadList:
+            t.start()
+        for t in threadList:
+            t.join()
+        elapsed = max(0.001, time.time() - startTime)
+        print('workers %d, threads %d, hash %d: %0.2f pos/s'\
+              %(workers, threads, hashValue, len(fens)/elapsed))
+        return len(fens)/elapsed, totalNodes[0]/elapsed
+
+    # Use all cores with each number of threads, then try smaller hash
+    # on the best config.
+    results = []
+    threads = 1
+    while threads <= numCores:
+        workers = numCores / threads
+        hashValue = GetHash(workers)
+        results.append((workers, threads, hashValue) +
+                       Measure(workers, threads, hashValue))
+        threads *= 2
+    best = max(results, key=lambda r: r[3])
+    for hashValue in [best[2] / 4, best[2] / 16]:
+        if hashValue >= CALIBRATE_MIN_HASH:
+            results.append((best[0], best[1], hashValue) +
+                           Measure(best[0], best[1], hashValue))
+    best = max(results, key=lambda r: r[3])
+
+    with open(outfn, 'w') as f:
+        f.write('# %s calibration of %s on %s\n'\
+                %(APP_NAME, g.engIdName, socket.gethostname()))
+        f.write('# %d positions to depth %d, %d cores, %d MB hash budget\n'\
+                %(len(fens), depth, numCores, ramBudget))
+        f.write('# %7s %7s %7s %8s %10s\n'\
+                %('workers', 'threads', 'hash', 'pos/s', 'knps'))
+        for workers, threads, hashValue, posRate, nps in results:
+            f.write('# %7d %7d %7d %8.2f %10.1f\n'\
+                    %(workers, threads, hashValue, posRate, nps/1000.0))
+        f.write('-workers %d\n' %(best[0]))
+        f.write('-engoptions Hash value %d, Threads value %d\n'\
+                %(best[2], best[1]))
+    print('Recommended: -workers %d -engoptions "Hash value %d, Threads value %d"'\
+          %(best[0], best[2], best[1]))
+    print('Profile is saved in %s' %(outfn))
+
 def main(argv):
     """ start """
     PrintProgram()
@@ -1738,16 +4644,37 @@ def main(argv):
     inputFile = 'src.pgn'
     outputFile = 'out_src.pgn'
     engineName = 'engine.exe'
-    bookOption = 'none'   # ['none', 'cerebellum', 'polyglot']
-    evalOption = 'static' # ['none', 'static', 'search']
+    bookOption = ANALYZE_OPTIONS['-book']
+    evalOption = ANALYZE_OPTIONS['-eval']
     cereBookFile = 'Cerebellum_Light.bin'
-    moveTimeOption = 0
-    moveStartOption = 8
-    jobOption = 'analyze' # ['none' 'analyze', 'test']
-    engOption = 'none'
+    moveTimeOption = ANALYZE_OPTIONS['-movetime']
+    jobOption = ANALYZE_OPTIONS['-job']
+    engOption = ANALYZE_OPTIONS['-engoptions']
+    roleOption = 'none' # ['none', 'coordinator', 'worker', 'server']
+    portOption = DEFAULT_SERVER_PORT
+    filterOption = ANALYZE_OPTIONS['-filter']
+    queueDirOption = 'queue'
+    leaseOption = DEFAULT_LEASE_TIME
+    workersOption = 0
+    jobSizeOption = 1
+    dedupOption = ANALYZE_OPTIONS['-dedup']
+    recordsOption = ANALYZE_OPTIONS['-records']
+    benchDepthOption = CALIBRATE_DEPTH
+    incrementalOption = ANALYZE_OPTIONS['-incremental']
+    watchOption = ANALYZE_OPTIONS['-watch']
+    ramOption = 0
     
     # Evaluate the command line options.
     options = EvaluateOptions(argv)
+
+    # Options from a calibration profile, the command line comes first.
+    if options.has_key('-profile'):
+        if not os.path.isfile(options['-profile']):
+            print('Error! %s is missing' %(options['-profile']))
+            sys.exit(1)
+        profile = ReadProfile(options['-profile'])
+        profile.update(options)
+        options = profile
     if len(options):
         inputFile = GetOptionValue(options, '-infile', inputFile)
         outputFile = GetOptionValue(options, '-outfile', outputFile)
@@ -1755,12 +4682,65 @@ def main(argv):
         bookOption = GetOptionValue(options, '-book', bookOption)
         evalOption = GetOptionValue(options, '-eval', evalOption)
         moveTimeOption = GetOptionValue(options, '-movetime', moveTimeOption)
-        moveStartOption = GetOptionValue(options, '-movestart', moveStartOption)
         jobOption = GetOptionValue(options, '-job', jobOption)
         engOption = GetOptionValue(options, '-engoptions', engOption)
+        roleOption = GetOptionValue(options, '-role', roleOption)
+        queueDirOption = GetOptionValue(options, '-queuedir', queueDirOption)
+        leaseOption = GetOptionValue(options, '-lease', leaseOption)
+        workersOption = GetOptionValue(options, '-workers', workersOption)
+        jobSizeOption = GetOptionValue(options, '-jobsize', jobSizeOption)
+        dedupOption = GetOptionValue(options, '-dedup', dedupOption)
+        recordsOption = GetOptionValue(options, '-records', recordsOption)
+        benchDepthOption = GetOptionValue(options, '-benchdepth',
+                                          benchDepthOption)
+        ramOption = GetOptionValue(options, '-ram', ramOption)
+        incrementalOption = GetOptionValue(options, '-incremental',
+                                           incrementalOption)
+        watchOption = GetOptionValue(options, '-watch', watchOption)
+        portOption = GetOptionValue(options, '-port', portOption)
+        filterOption = GetOptionValue(options, '-filter', filterOption)
+
+    # A worker gets the input and the options from the coordinator.
+    if roleOption == 'worker':
+        if not os.path.isfile(engineName):
+            print('Error! %s is missing' %(engineName))
+            sys.exit(1)
+        RunWorker(queueDirOption, engineName, engOption)
+        print('Done!!\n')
+        return
+
+    # The pgn readers are compared without an engine and an output file.
+    if jobOption == 'readbench':
+        if not os.path.isfile(inputFile):
+            print('Error! %s is missing' %(inputFile))
+            sys.exit(1)
+        RunReadBenchmark(inputFile)
+        print('Done!!\n')
+        return
+
+    # Several engines and their options are separated by ';'.
+    engineNames = engineName.split(';')
+    engOptions = engOption.split(';')
+    if len(engOptions) == 1:
+        engOptions = engOptions * len(engineNames)
+    if jobOption == 'compare' and len(engOptions) != len(engineNames):
+        print('Error! -engoptions should be given for each engine.')
+        sys.exit(1)
 
-    # Check input, output and engine files.
-    CheckFiles(inputFile, outputFile, engineName)
+    # Check input, output and engine files. The coordinator only needs
+    # the engine when it starts local workers, the server has no files.
+    if roleOption == 'server':
+        if not os.path.isfile(engineName):
+            print('Error! %s is missing' %(engineName))
+            sys.exit(1)
+    elif roleOption == 'coordinator' and workersOption <= 0:
+        CheckFiles(inputFile, outputFile, None)
+    elif jobOption == 'compare':
+        CheckFiles(inputFile, outputFile, None)
+        for eng in engineNames:
+            CheckFiles(inputFile, outputFile, eng)
+    else:
+        CheckFiles(inputFile, outputFile, engineName)
     
     # Disable use of cerebellum book when Cerebellum_Light.bin is missing.
     if bookOption == 'cerebellum':
@@ -1780,27 +4760,102 @@ def main(argv):
         print('Error! options were not defined. Nothing has been processed.')
         sys.exit(1)
 
-    # Exit if file type is epd and move time is 0.
-    if fileType == EPD_FILE and moveTimeOption <= 0 and evalOption != 'static':
+    # Exit if file type is epd or engines are compared and move time is 0.
+    if fileType == EPD_FILE and moveTimeOption <= 0 and evalOption != 'static'\
+       and jobOption != 'calibrate'\
+       or jobOption == 'compare' and moveTimeOption <= 0\
+       or roleOption == 'server' and moveTimeOption <= 0:
         print('Error! movetime is zero.')
         sys.exit(1)
 
     # Exit if analyzing epd with -eval none
-    if fileType == EPD_FILE and evalOption == 'none' and jobOption != 'test':
+    if fileType == EPD_FILE and evalOption == 'none'\
+       and jobOption not in ['test', 'solve', 'compare', 'calibrate']:
         print('Error! -eval was set to none.')
         sys.exit(1)
+
+    # Exit if epd test is run by coordinator, results are not per line.
+    if roleOption == 'coordinator' and\
+       jobOption in ['test', 'solve', 'compare', 'calibrate']:
+        print('Error! -job %s is not supported with -role coordinator.'\
+              %(jobOption))
+        sys.exit(1)
         
-    # Delete existing output file.
-    DeleteFile(outputFile)
+    # The records are written by the process that annotates the games.
+    if roleOption == 'coordinator' and recordsOption != 'none':
+        print('Error! -records is not supported with -role coordinator.')
+        sys.exit(1)
+
+    # The positions of -job extract are taken from games.
+    if jobOption == 'extract' and fileType != PGN_FILE:
+        print('Error! -job extract needs a pgn infile.')
+        sys.exit(1)
+
+    # Exit if a -filter condition is not valid.
+    try:
+        GetGameFilter(filterOption)
+    except ValueError as e:
+        print('Error! %s' %(e))
+        sys.exit(1)
+
+    # Delete existing output file, it is updated by -incremental.
+    if roleOption == 'coordinator' and incrementalOption == 'on':
+        print('Error! -incremental is not supported with -role coordinator.')
+        sys.exit(1)
+    if watchOption == 'on':
+        if roleOption == 'coordinator' or recordsOption != 'none'\
+           or incrementalOption == 'on' or dedupOption == 'on'\
+           or jobOption == 'extract':
+            print('Error! -watch on is not supported with -role coordinator, -records, -incremental, -dedup or -job extract.')
+            sys.exit(1)
+    if roleOption != 'server':
+        if incrementalOption != 'on' or fileType != PGN_FILE:
+            DeleteFile(outputFile)
+        if recordsOption != 'none':
+            DeleteFile(recordsOption)
         
-    # Convert options to dict.
-    options = {'-book': bookOption,
-               '-eval': evalOption,
-               '-movetime': moveTimeOption,
-               '-movestart': moveStartOption,
-               '-job': jobOption,
-               '-engoptions': engOption
-               }
+    # Convert options to dict. The options of class Analyze that are not
+    # checked above are taken from the command line as they are.
+    cmdOptions = options
+    options = {}
+    for k, v in ANALYZE_OPTIONS.items():
+        options[k] = GetOptionValue(cmdOptions, k, v)
+    options['-book'] = bookOption
+
+    # Find the workers, Threads and Hash with the best throughput, half
+    # of the memory is used for hash if -ram is not given.
+    if jobOption == 'calibrate':
+        if ramOption <= 0:
+            ramOption = (GetPhysicalMemory() or 2048) / 2
+        RunCalibration(inputFile, outputFile, fileType, options, engineName,
+                       ramOption, benchDepthOption)
+        print('Done!!\n')
+        return
+
+    # Search the positions with each engine, workers is the number of
+    # cores that are used.
+    if jobOption == 'compare':
+        numCores = workersOption
+        if numCores <= 0:
+            numCores = multiprocessing.cpu_count()
+        RunEngineComparison(inputFile, outputFile, fileType, options,
+                            engineNames, engOptions, numCores)
+        print('Done!!\n')
+        return
+
+    # The server analyzes the requests of its clients with warm engines.
+    if roleOption == 'server':
+        RunServer(engineName, options, portOption, workersOption)
+        print('Done!!\n')
+        return
+
+    # The coordinator splits the input and the workers annotate it.
+    if roleOption == 'coordinator':
+        RunCoordinator(inputFile, outputFile, fileType, options,
+                       queueDirOption, leaseOption, workersOption,
+                       jobSizeOption, engineName, engOption)
+        print('Done!!\n')
+        return
 
     # Create an object of class Analyze.
     g = Analyze(inputFile, outputFile, engineName, **options)
@@ -1810,6 +4865,8 @@ def main(argv):
     if fileType == EPD_FILE:
         if jobOption == 'test':
             g.TestEngineWithEpd()
+        elif jobOption == 'solve':
+            g.SolveEpdWithEngine()
         else:
             g.AnnotateEpd()
     elif fileType == PGN_FILE:
@@ -0,0 +1,96 @@
+""" Importable api of chess-artist.
+
+The annotator runs the engine in the process of the caller and yields the
+analysis of each ply or position as soon as it is done, writing a pgn or
+epd output file is optional.
+
+    import chess.pgn
+    from chessartist import Annotator
+
+    annotator = Annotator('Sf.exe', eval='search', movetime=1000)
+    game = chess.pgn.read_game(open('mygame.pgn'))
+    for record in annotator.AnnotateGame(game):
+        print('%s %s %s' %(record['move'], record['posScore'],
+                           record['bestMove']))
+    annotator.Close()
+"""
+
+
+import os
+import imp
+
+
+# The file name of chess-artist.py is not a module name.
+SCRIPT_FILE = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'chess-artist.py')
+script = imp.load_source('chess_artist', SCRIPT_FILE)
+Analyze = script.Analyze
+
+# The command line options without the dash, and their defaults.
+DEFAULT_OPTIONS = dict([(k[1:], v) for k, v in script.ANALYZE_OPTIONS.items()])
+
+
+class Annotator():
+    """ Annotates games and positions with an engine, the options are
+        the options of the command line without the dash, for example
+        Annotator('Sf.exe', eval='search', movetime=1000, session='game')
+    """
+    def __init__(self, eng, **options):
+        """ Initialize """
+        opt = {}
+        for k, v in DEFAULT_OPTIONS.items():
+            opt['-' + k] = options.get(k, v)
+        for k in options:
+            if k not in DEFAULT_OPTIONS:
+                raise ValueError('Unknown option %s' %(k))
+        if opt['-book'] == 'cerebellum' and\
+           not os.path.isfile('Cerebellum_Light.bin'):
+            opt['-book'] = 'none'
+            print('Warning! cerebellum book is missing.')
+        self.analyze = Analyze(None, None, eng, **opt)
+        self.analyze.isQuiet = True
+        self.analyze.CheckEngineCapabilities()
+
+    def GetEngineIdName(self):
+        """ Returns the id name of the engine """
+        return self.analyze.engIdName
+
+    def AnnotateGame(self, game, outfn=None):
+        """ Yields the record of each ply in the main line of game, a dict
+            like the json lines of -records. The annotated game is also
+            appended to outfn when it is given.
+        """
+        self.analyze.outfn = outfn
+        for record in self.analyze.AnnotateGamePlies(game):
+            yield record
+
+    def AnnotatePgn(self, infn, outfn=None):
+        """ Yields the records of the plies of all games in infn """
+        self.analyze.infn = infn
+        for game in self.analyze.ReadGames():
+            for record in self.AnnotateGame(game, outfn):
+                yield record
+
+    def AnnotatePgnText(self, pgnText, outfn=None):
+        """ Yields the records of the plies of the first game in pgnText """
+        game = script.ReadMainLineGame(pgnText)
+        if game is None:
+            return
+        for record in self.AnnotateGame(game, outfn):
+            yield record
+
+    def AnnotateFens(self, fens, outfn=None):
+        """ Yields a dict with the epd, fen, acd, acs, bm and ce of each
+            fen or epd line in fens, positions without a legal move are
+            skipped. The epd lines with the opcodes are also appended to
+            outfn when it is given.
+        """
+        if self.analyze.evalOpt == 'none':
+            raise ValueError('Positions need eval static or search')
+        self.analyze.outfn = outfn
+        for record in self.analyze.AnnotateEpdLines(fens):
+            yield record
+
+    def Close(self):
+        """ Quits the engine of a game session """
+        self.analyze.QuitSessionEngine()